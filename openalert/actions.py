@@ -1,8 +1,11 @@
-import json
 from logger import openalert_logger, debug_action_logger
 from opensearchpy import helpers
 
 
+# Alerts have deterministic ids, creating an alert indexed by a previous run is a no-op
+CONFLICT = 409
+
+
 class Action(object):
     def __init__(self):
         pass
@@ -16,33 +19,41 @@ class DebugAction(Action):
 
     def send(self, alerts=None, config=None):
         for alert in alerts:
-            debug_action_logger.debug(json.dumps(alert))
+            debug_action_logger.debug(alert.to_json())
 
 
 class IndexerAction(Action):
-    def __init__(self):
+    def __init__(self, writer=None):
         super().__init__()
+        # writer: optional BulkWriter, alerts are then queued and indexed in the background
+        self.writer = writer
 
     @staticmethod
     def _build_document(alert, index):
-        """Build a single document."""
+        """Build a single document. The source is already serialized, the bulk helper sends it as is."""
         return {
             '_op_type': 'create',
             '_index': index,
-            '_source': alert
+            '_id': alert.get_id(),
+            '_source': alert.to_json()
         }
 
     def _build_documents(self, alerts, index):
-        """Build a list of documents for indexing."""
-        return [self._build_document(alert, index) for alert in alerts]
+        """Build the documents for indexing, lazily as the bulk helper consumes them."""
+        return (self._build_document(alert, index) for alert in alerts)
 
 
     def send(self, alerts=None, config=None):
-        """Send bulk-indexed documents to OpenSearch."""
+        """Send bulk-indexed documents to OpenSearch.
+
+        With a background writer the alerts are only queued, `config['callback']` gets the result later."""
+        if self.writer is not None:
+            return self.writer.submit(alerts, config.get('callback'))
+
         try:
             index = config['index']
             documents = self._build_documents(alerts, index)
-            response = helpers.bulk(config['client'], documents)
+            response = helpers.bulk(config['client'], documents, ignore_status=(CONFLICT,))
             # openalert_logger.info(f'Indexed {response[0]} alerts')
             return response
         except Exception as e:
@@ -50,6 +61,17 @@ class IndexerAction(Action):
             return None
 
 
+    async def async_send(self, alerts=None, config=None):
+        """Send bulk-indexed documents to OpenSearch with an AsyncOpenSearch client."""
+        try:
+            index = config['index']
+            documents = self._build_documents(alerts, index)
+            return await helpers.async_bulk(config['client'], documents, ignore_status=(CONFLICT,))
+        except Exception as e:
+            openalert_logger.error(f'Error indexing alerts: {e}')
+            return None
+
+
 class EmailAction(Action):
     def __init__(self):
         super().__init__()
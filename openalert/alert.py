@@ -0,0 +1,116 @@
+import hashlib
+import json
+
+from opensearchpy.serializer import JSONSerializer
+
+
+METADATA = '_metadata'
+INDEX = '_index'
+ID = '_id'
+RULE = 'rule'
+RULE_NAME = 'name'
+RULE_ID = 'id'
+RULE_DESCRIPTION = 'description'
+RISK_SCORE = 'risk_score'
+SEVERITY_LABEL = 'severity_label'
+RULE_TAGS = 'tags'
+RULE_THREAT = 'threat'
+EVENT = 'event'
+TIMESTAMP = '@timestamp'
+MATCH = 'match'
+INDICATOR = 'indicator'
+SUPPRESSION = 'suppression'
+
+# Same output as the bulk helper serializer, so documents are identical whether they are sent as dicts or JSON
+serializer = JSONSerializer()
+
+
+def dumps(value) -> str:
+    return json.dumps(value, default=serializer.default, ensure_ascii=False, separators=(',', ':'))
+
+
+def get_alert_id(*parts) -> str:
+    """Stable document id of an alert, the same match always gets the same id."""
+    return hashlib.sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+class RuleMetadata(object):
+    """Rule block of the alerts of one rule version, built and serialized once and shared by all its alerts.
+
+    `fields` is shared, it must not be modified."""
+    __slots__ = ('rule', 'fields', 'json')
+
+    def __init__(self, rule: dict):
+        self.rule = rule
+        self.fields = {
+            RULE_NAME: rule[RULE_NAME],
+            RULE_ID: rule[RULE_ID],
+            RULE_DESCRIPTION: rule[RULE_DESCRIPTION],
+            RISK_SCORE: rule['riskScore'],
+            SEVERITY_LABEL: rule['severity'],
+            RULE_TAGS: rule[RULE_TAGS],
+            RULE_THREAT: rule[RULE_THREAT],
+        }
+        self.json = dumps(self.fields)
+
+
+class Alert(object):
+    """One alert: the matched event, its source document and the shared rule metadata.
+
+    The alert document is only built when an action serializes it, with to_json (bulk, debug) or to_dict."""
+    __slots__ = ('timestamp', 'metadata', 'index', 'id', 'match', 'indicator', 'suppression')
+
+    def __init__(self, timestamp: str, metadata: RuleMetadata, match: dict, index=None, id=None, indicator=None,
+                 suppression=None):
+        self.timestamp = timestamp
+        self.metadata = metadata
+        self.match = match
+        # index/id: source document of the event, None for events without one (e.g. count results)
+        self.index = index
+        self.id = id
+        self.indicator = indicator
+        # suppression: { terms, count, start, end } of a roll-up alert replacing the alerts suppressed in a window
+        self.suppression = suppression
+
+
+    def get_id(self) -> str:
+        """Document id of the alert: (rule id, source index, source id), so a re-match is the same document.
+
+        Alerts without a source document (e.g. count results) use their group key and the run timestamp, so
+        only rewrites of the same run are the same document. A roll-up alert is identified by its window."""
+        rule_id = self.metadata.fields[RULE_ID]
+        if self.suppression is not None:
+            return get_alert_id(rule_id, SUPPRESSION, dumps(self.suppression['terms']), self.suppression['start'])
+        if self.index is not None or self.id is not None:
+            return get_alert_id(rule_id, self.index, self.id)
+        key = self.match.get('key', self.match) if isinstance(self.match, dict) else self.match
+        return get_alert_id(rule_id, json.dumps(key, sort_keys=True, default=str), self.timestamp)
+
+
+    def to_dict(self) -> dict:
+        """Alert document. The rule block is the shared metadata, not a copy."""
+        alert = {TIMESTAMP: self.timestamp}
+        if self.index is not None or self.id is not None:
+            alert[METADATA] = {INDEX: self.index, ID: self.id}
+        alert[RULE] = self.metadata.fields
+        alert[EVENT] = {MATCH: self.match}
+        if self.indicator is not None:
+            alert[EVENT][INDICATOR] = self.indicator
+        if self.suppression is not None:
+            alert[SUPPRESSION] = self.suppression
+        return alert
+
+
+    def to_json(self) -> str:
+        """Alert document as JSON, the rule block is spliced in already serialized."""
+        parts = ['{"', TIMESTAMP, '":', dumps(self.timestamp)]
+        if self.index is not None or self.id is not None:
+            parts += [',"', METADATA, '":', dumps({INDEX: self.index, ID: self.id})]
+        parts += [',"', RULE, '":', self.metadata.json, ',"', EVENT, '":{"', MATCH, '":', dumps(self.match)]
+        if self.indicator is not None:
+            parts += [',"', INDICATOR, '":', dumps(self.indicator)]
+        parts.append('}')
+        if self.suppression is not None:
+            parts += [',"', SUPPRESSION, '":', dumps(self.suppression)]
+        parts.append('}')
+        return ''.join(parts)
@@ -0,0 +1,153 @@
+import asyncio
+import threading
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from executor import Executor, RULE_ID, DEFAULT_MSEARCH_CONCURRENCY
+from ultils import ts_now
+from logger import openalert_logger
+from opensearch_client import create_async_client
+
+
+class AsyncExecutor(Executor):
+    """Executor running rule groups as coroutines on one asyncio event loop.
+
+    Group msearch requests go through AsyncOpenSearch so that the network round-trips of all groups overlap
+    in the loop. Per-rule post-processing (paging, enhancements, actions) is CPU and blocking-client work, it
+    still runs in the worker pool and is awaited from the loop. Alerts are written by the threaded BulkWriter
+    (opensearch.bulk.background, the default), only with background false they are bulk indexed from the
+    loop."""
+    def __init__(self, rules, disabled_rules, exceptions, config):
+        # The loop exists before Executor.__init__ creates the scheduler on it
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name='openalert_loop', daemon=True)
+
+        super().__init__(rules, disabled_rules, exceptions, config)
+        self.async_client = create_async_client(config)
+
+        # group_tasks: group runs in progress, stop waits for them before closing the client and the loop
+        self.group_tasks = set()
+
+        # Bound the number of msearch requests in flight across all groups
+        self.search_semaphore = asyncio.Semaphore(
+            config['rule'].get('msearchConcurrency', DEFAULT_MSEARCH_CONCURRENCY))
+
+
+    def _create_search_workers(self, config):
+        """No pool, msearch requests are coroutines bounded by search_semaphore."""
+        return None
+
+
+    def _create_scheduler(self):
+        return AsyncIOScheduler(event_loop=self.loop)
+
+
+    async def _async_msearch(self, searches) -> list:
+        """Send one multi-search request for a batch of (rule, query, aggregation) and return its responses."""
+        msearch_body = []
+        for rule, query, _ in searches:
+            msearch_body.extend([
+                {"index": rule['index']},
+                query
+            ])
+
+        params = {}
+        if self.maxConcurrentSearches:
+            params['max_concurrent_searches'] = self.maxConcurrentSearches
+        async with self.search_semaphore:
+            response = await self.async_client.msearch(msearch_body, params=params)
+        return response['responses']
+
+
+    async def _run_batch(self, batch, window_ends: dict, timestamp: str) -> list:
+        """Search a batch of rules and process each rule in the worker pool."""
+        try:
+            responses = await self._async_msearch(batch)
+        except Exception as e:
+            openalert_logger.error(f"Cannot get data from OpenSearch. ERROR: {e}")
+            for rule, _, _ in batch:
+                window_ends.pop(rule[RULE_ID], None)
+            return []
+
+        loop = asyncio.get_running_loop()
+        rule_futures = []
+        for (rule, query, aggregation), response in zip(batch, responses):
+            if self._is_response_valid(rule, aggregation, response, window_ends):
+                rule_futures.append((rule, loop.run_in_executor(self.workers, self._process_rule, rule, query,
+                                                                response, timestamp, aggregation)))
+
+        batch_alerts = []
+        for rule, future in rule_futures:
+            try:
+                batch_alerts.extend(await future)
+            except Exception as e:
+                openalert_logger.error(fr'Cannot process rule: {rule["name"]}. ERROR: {e}')
+                window_ends.pop(rule[RULE_ID], None)
+
+        return batch_alerts
+
+
+    async def run_rule_group(self, interval: int):
+        """Run all rules in a group."""
+        task = asyncio.current_task()
+        self.group_tasks.add(task)
+        try:
+            await self._run_rule_group(interval)
+        finally:
+            self.group_tasks.discard(task)
+
+
+    async def _run_rule_group(self, interval: int):
+        openalert_logger.info(fr'Running rule group: {interval}...')
+        searches, window_ends = self._prepare_searches(interval)
+        if not searches:
+            return
+
+        # Batches are searched and processed concurrently, results are merged in rule order
+        timestamp = ts_now()
+        results = await asyncio.gather(*[self._run_batch(batch, window_ends, timestamp)
+                                         for batch in self._split_batches(searches)])
+        group_alerts = [alert for batch_alerts in results for alert in batch_alerts]
+
+        if self.debug:
+            self._commit_watermarks(window_ends, timestamp)
+            return
+
+        if self.bulk_writer is not None:
+            # Queueing blocks while the writer queue is full, keep it off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self._queue_alerts, interval, group_alerts,
+                                                             window_ends, timestamp)
+            return
+
+        # Use the Bulk API to send all alerts to OpenSearch.
+        opensearch_config = {
+            'client': self.async_client,
+            'index': self.writeBackIndex
+        }
+        response = await self.actions['indexer'].async_send(group_alerts, opensearch_config)
+        self._on_alerts_sent(interval, response, window_ends, timestamp)
+
+
+    def start(self):
+        """Start the event loop, then the executor."""
+        self.loop_thread.start()
+        super().start()
+
+
+    def _wait_for_groups(self):
+        """Wait for the group runs in progress on the loop, they still index alerts and commit watermarks."""
+        async def wait():
+            tasks = list(self.group_tasks)
+            if tasks:
+                openalert_logger.info(fr'Waiting for {len(tasks)} rule groups to finish...')
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(wait(), self.loop).result()
+
+
+    def stop(self):
+        """Stop the executor, then close the async client and the event loop."""
+        super().stop()
+        asyncio.run_coroutine_threadsafe(self.async_client.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
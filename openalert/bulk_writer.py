@@ -0,0 +1,236 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from opensearchpy import helpers
+
+from logger import openalert_logger
+
+
+DEFAULT_QUEUE_SIZE = 100000
+DEFAULT_FLUSH_COUNT = 1000
+DEFAULT_FLUSH_BYTES = 5 * 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_THREADS = 2
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_INITIAL_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 60.0
+DEFAULT_DEDUPE_CACHE_SIZE = 100000
+TOO_MANY_REQUESTS = 429
+CONFLICT = 409
+STOP = object()
+
+
+class BulkTicket(object):
+    """Alerts of one submission (e.g. a group run). `callback(success, errors)` is called once all are written."""
+    def __init__(self, count: int, callback=None):
+        self.remaining = count
+        self.success = 0
+        self.errors = []
+        self.callback = callback
+        self.lock = threading.Lock()
+
+
+    def done(self, ok: bool, item):
+        with self.lock:
+            if ok:
+                self.success += 1
+            else:
+                self.errors.append(item)
+            self.remaining -= 1
+            finished = self.remaining == 0
+        if finished:
+            self.finish()
+
+
+    def finish(self):
+        if self.callback is None:
+            return
+        try:
+            self.callback(self.success, self.errors)
+        except Exception as e:
+            openalert_logger.error(f'Error in bulk write callback: {e}')
+
+
+class RecentIds(object):
+    """LRU set of the alert ids written recently."""
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def __contains__(self, alert_id):
+        with self.lock:
+            if alert_id not in self.ids:
+                return False
+            self.ids.move_to_end(alert_id)
+            return True
+
+
+    def add(self, alert_id):
+        if not self.max_size:
+            return
+        with self.lock:
+            self.ids[alert_id] = None
+            self.ids.move_to_end(alert_id)
+            if len(self.ids) > self.max_size:
+                self.ids.popitem(last=False)
+
+
+class BulkWriter(object):
+    """Long-lived writer indexing alerts in the background.
+
+    Alerts are queued (bounded, a full queue blocks the producer) and serialized by a batching thread, which
+    flushes a batch when it reaches flushCount documents, flushBytes characters or flushInterval seconds.
+    Batches are sent by `threads` sender threads, each on its own connection of the client pool. Documents
+    rejected with 429 are retried with exponential backoff, other failures are reported to their ticket.
+
+    Alerts have deterministic ids: an alert written recently (dedupeCacheSize ids) is dropped before the
+    request, one already in the index is rejected by `create` and counted as written."""
+    def __init__(self, client, index: str, config: dict = None):
+        config = config or {}
+        self.client = client
+        self.index = index
+        self.queue = queue.Queue(maxsize=config.get('queueSize', DEFAULT_QUEUE_SIZE))
+        self.flush_count = config.get('flushCount', DEFAULT_FLUSH_COUNT)
+        self.flush_bytes = config.get('flushBytes', DEFAULT_FLUSH_BYTES)
+        self.flush_interval = config.get('flushInterval', DEFAULT_FLUSH_INTERVAL)
+        self.max_retries = config.get('maxRetries', DEFAULT_MAX_RETRIES)
+        self.initial_backoff = config.get('initialBackoff', DEFAULT_INITIAL_BACKOFF)
+        self.max_backoff = config.get('maxBackoff', DEFAULT_MAX_BACKOFF)
+        self.recent_ids = RecentIds(config.get('dedupeCacheSize', DEFAULT_DEDUPE_CACHE_SIZE))
+
+        threads = config.get('threads', DEFAULT_THREADS)
+        self.senders = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='bulk_sender')
+        # At most one batch waiting per sender, then the batching thread (and so the queue) waits
+        self.in_flight = threading.BoundedSemaphore(threads * 2)
+        self.batcher = threading.Thread(target=self._run, name='bulk_batcher', daemon=True)
+
+        self.stats_lock = threading.Lock()
+        self.stats = {'sent': 0, 'failed': 0, 'retried': 0, 'duplicates': 0, 'requests': 0}
+
+
+    def start(self):
+        self.batcher.start()
+
+
+    def close(self):
+        """Flush the queued alerts and stop the threads."""
+        if self.batcher.is_alive():
+            self.queue.put(STOP)
+            self.batcher.join()
+        self.senders.shutdown(wait=True)
+
+
+    def queue_depth(self) -> int:
+        """Number of alerts queued and not yet batched."""
+        return self.queue.qsize()
+
+
+    def submit(self, alerts: list, callback=None) -> BulkTicket:
+        """Queue alerts for indexing. Blocks while the queue is full."""
+        ticket = BulkTicket(len(alerts), callback)
+        if not alerts:
+            ticket.finish()
+            return ticket
+
+        for alert in alerts:
+            self.queue.put((alert, ticket))
+        return ticket
+
+
+    def _run(self):
+        """Batch queued alerts by count, size or time and hand the batches to the senders."""
+        batch, size, deadline = [], 0, None
+        while True:
+            timeout = max(0.0, deadline - time.monotonic()) if batch else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is STOP:
+                if batch:
+                    self._flush(batch)
+                return
+
+            if item is not None:
+                alert, ticket = item
+                try:
+                    alert_id = alert.get_id()
+                    if alert_id in self.recent_ids:
+                        self._count('duplicates')
+                        ticket.done(True, {'create': {'_id': alert_id, 'status': CONFLICT}})
+                        continue
+                    document = alert.to_json()
+                except Exception as e:
+                    ticket.done(False, {'create': {'error': f'Cannot serialize alert: {e}'}})
+                    continue
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append((alert_id, document, ticket))
+                size += len(document)
+
+            if batch and (item is None or len(batch) >= self.flush_count or size >= self.flush_bytes
+                          or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch, size = [], 0
+
+
+    def _flush(self, batch: list):
+        self.in_flight.acquire()
+        future = self.senders.submit(self._send, batch)
+        future.add_done_callback(lambda _: self.in_flight.release())
+
+
+    def _build_action(self, alert_id: str, document: str) -> dict:
+        return {'_op_type': 'create', '_index': self.index, '_id': alert_id, '_source': document}
+
+
+    def _send(self, batch: list):
+        """Send one batch, retrying the documents rejected with 429. Every document ends in its ticket."""
+        pending = batch
+        for attempt in range(self.max_retries + 1):
+            retry = []
+            position = 0
+            try:
+                actions = [self._build_action(alert_id, document) for alert_id, document, _ in pending]
+                results = helpers.streaming_bulk(self.client, actions, chunk_size=len(pending), raise_on_error=False,
+                                                 raise_on_exception=False)
+                for (alert_id, document, ticket), (ok, item) in zip(pending, results):
+                    position += 1
+                    status = next(iter(item.values()), {}).get('status')
+                    if not ok and status == TOO_MANY_REQUESTS and attempt < self.max_retries:
+                        retry.append((alert_id, document, ticket))
+                        continue
+                    if not ok and status == CONFLICT:
+                        ok = True  # Written by a previous run
+                        self._count('duplicates')
+                    else:
+                        self._count('sent' if ok else 'failed')
+                    if ok:
+                        self.recent_ids.add(alert_id)
+                    ticket.done(ok, item)
+            except Exception as e:
+                openalert_logger.error(f'Error indexing alerts: {e}')
+                for _, _, ticket in pending[position:]:
+                    self._count('failed')
+                    ticket.done(False, {'create': {'error': str(e)}})
+
+            self._count('requests')
+            if not retry:
+                return
+
+            backoff = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+            openalert_logger.warning(f'{len(retry)} alerts rejected by OpenSearch (429), retrying in {backoff}s')
+            self._count('retried', len(retry))
+            time.sleep(backoff)
+            pending = retry
+
+
+    def _count(self, stat: str, value: int = 1):
+        with self.stats_lock:
+            self.stats[stat] += value
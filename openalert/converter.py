@@ -1,8 +1,13 @@
 import copy
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
 
 from sigma.collection import SigmaCollection
 from sigma.backends.elasticsearch.elasticsearch_lucene import LuceneBackend
 
+from eql_aggregation import DEFAULT_COMPOSITE_SIZE
 from logger import openalert_logger
 
 
@@ -16,6 +21,12 @@ SOURCE = "_source"
 INCLUDES = "includes"
 EXCLUDES = "excludes"
 OPEN_SEARCH_QUERY = "OpenSearchQuery"
+OPEN_SEARCH_AGGREGATION = "OpenSearchAggregation"
+THRESHOLD = "threshold"
+THRESHOLD_AGGREGATION = "threshold"
+FIRST_SEEN = "first_seen"
+LAST_SEEN = "last_seen"
+TIMESTAMP = "@timestamp"
 
 # Generic Sigma Rule (unchanged)
 generic_sigma_rule = {
@@ -34,23 +45,96 @@ pattern_query = {
 }
 
 
+def get_backend_versions() -> dict:
+    """Versions of pySigma and its backend, a conversion may change when they are upgraded."""
+    versions = {}
+    for package in ('pySigma', 'pySigma-backend-elasticsearch'):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def convert_section(section: dict) -> dict:
+    """Convert one query section in a startup pool process. Failures are left to the sequential conversion."""
+    try:
+        return Converter._convert_query(section)
+    except Exception:
+        return {}
+
+
 class Converter(object):
-    def __init__(self):
-        pass
+    def __init__(self, cache=None):
+        # cache: optional ConversionCache shared by the startup conversion and the watchers
+        self.cache = cache
+        self.backend_versions = get_backend_versions()
+        # prefetched: { cache key: query } - converted by the process pool during convert_all
+        self.prefetched = {}
 
 
-    @staticmethod
-    def convert_query(section: dict) -> dict:
+    def _get_cache_key(self, section: dict) -> str:
+        content = json.dumps({'detection': section, 'versions': self.backend_versions}, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+    def convert_query(self, section: dict) -> dict:
         """Convert query section of rule to filter section in OpenSearch query."""
-        generic_sigma_rule["detection"] = section
+        if self.cache is None and not self.prefetched:
+            return self._convert_query(section)
+
+        key = self._get_cache_key(section)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+        if key in self.prefetched:
+            result = copy.deepcopy(self.prefetched[key])
+        else:
+            result = self._convert_query(section)
+        if result and self.cache is not None:
+            self.cache.set(key, copy.deepcopy(result))
+        return result
+
+
+    def prefetch(self, sections: list, workers: int):
+        """Convert the sections missing from the cache in a pool of `workers` processes."""
+        pending = {}
+        for section in sections:
+            key = self._get_cache_key(section)
+            if key not in pending and (self.cache is None or not self.cache.contains(key)):
+                pending[key] = section
+        if not pending:
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunk_size = max(1, len(pending) // (workers * 4))
+            for key, result in zip(pending, pool.map(convert_section, pending.values(), chunksize=chunk_size)):
+                if result:
+                    self.prefetched[key] = result
+
+
+    @staticmethod
+    def _convert_query(section: dict) -> dict:
+        # Conversions run in several threads (rule workers, watchers), the template is never modified
+        rule = {**generic_sigma_rule, "detection": section}
         try:
-            sigma_rule = SigmaCollection.from_dicts([generic_sigma_rule])
+            sigma_rule = SigmaCollection.from_dicts([rule])
         except:
             return {}
 
         return LuceneBackend().convert(sigma_rule, output_format="dsl_lucene")[0]
 
 
+    def save_cache(self, prune=False):
+        """Persist new conversions. With `prune`, conversions not used since load are dropped first."""
+        if self.cache is None:
+            return
+        if prune:
+            self.cache.prune()
+        self.cache.save()
+
+
     def add_to_query(self, source: list, section: dict) -> bool:
         """Helper to convert and add a section to an OpenSearch query."""
         result = self.convert_query(section)
@@ -84,9 +168,36 @@ class Converter(object):
                 return {}
 
         rule[OPEN_SEARCH_QUERY] = query
+        if THRESHOLD in rule:
+            rule[OPEN_SEARCH_AGGREGATION] = self.build_threshold_aggregation(rule[THRESHOLD])
         return rule
 
 
+    @staticmethod
+    def build_threshold_aggregation(threshold: dict) -> dict:
+        """Aggregations of a threshold rule: a composite bucket per value of the threshold fields with its first and
+        last event, or only the first and last event when the whole window is counted."""
+        timestamps = {FIRST_SEEN: {'min': {'field': TIMESTAMP}}, LAST_SEEN: {'max': {'field': TIMESTAMP}}}
+        fields = threshold.get('field', [])
+        if not fields:
+            return timestamps
+
+        sources = [{fr'f{i}': {'terms': {'field': field}}} for i, field in enumerate(fields)]
+        return {THRESHOLD_AGGREGATION: {'composite': {'size': DEFAULT_COMPOSITE_SIZE, 'sources': sources},
+                                        'aggs': timestamps}}
+
+
+    @staticmethod
+    def build_final_query(query: dict, exceptions: list) -> dict:
+        """Return a new query with the MUST_NOT clauses of the exceptions appended. The input is not modified."""
+        must_not = list(query[QUERY][BOOL][MUST_NOT])
+        for exception in exceptions:
+            query_section = exception.get(OPEN_SEARCH_QUERY, {})
+            must_not.extend(query_section.get(QUERY, {}).get(BOOL, {}).get(MUST_NOT, []))
+
+        return {**query, QUERY: {**query[QUERY], BOOL: {**query[QUERY][BOOL], MUST_NOT: must_not}}}
+
+
     def convert_exception(self, exception: dict) -> dict:
         """Convert one exception."""
         query = copy.deepcopy(pattern_query)
@@ -98,8 +209,31 @@ class Converter(object):
         return exception
 
 
-    def convert_all(self, data:dict, data_type:str) -> dict:
-        """Generate OpenSearch queries from rules/exceptionsList."""
+    @staticmethod
+    def get_sections(value: dict, data_type: str) -> list:
+        """Query sections converted for a rule/exception."""
+        if data_type == 'rules':
+            return [value.get("query")] + value.get("exceptions", [])
+        if data_type == 'exceptionsList':
+            return list(value.get("exceptions", []))
+        return []
+
+
+    def convert_all(self, data:dict, data_type:str, workers=1) -> dict:
+        """Generate OpenSearch queries from rules/exceptionsList.
+
+        With several `workers`, pySigma conversions run in a process pool first, then the results are
+        assembled here in file order, so the output is the same as a sequential conversion."""
+        if workers > 1:
+            self.prefetch([section for value in data.values() for section in self.get_sections(value, data_type)],
+                          workers)
+        try:
+            return self._convert_all(data, data_type)
+        finally:
+            self.prefetched = {}
+
+
+    def _convert_all(self, data:dict, data_type:str) -> dict:
         for key, value in data.copy().items():
             if data_type == 'rules':
                 result = self.convert_rule(value)
@@ -1,11 +1,60 @@
 import copy
 import json
+import threading
+from datetime import datetime, timezone
+from functools import lru_cache
+
 import eql
+from eql.walkers import DEFAULT_TIME_UNIT
+
+from opensearchpy import helpers
 
-from converter import Converter, pattern_query, QUERY
+from converter import Converter, pattern_query, QUERY, BOOL, FILTER
+from eql_columnar import compile_query
+from eql_aggregation import plan_aggregation
 from logger import openalert_logger
-from ultils import get_nested_value
+from state import EqlSequenceStore
+from ultils import get_nested_value, get_nested_getter, ts_to_datetime, interval_to_seconds
 from opensearch_client import OpenSearchClient
+from indicator_store import IndicatorStore, SCAN_SIZE
+
+
+MATCHED_INDICATOR = '_indicator'
+TERMS = 'terms'
+CACHE_MODE = 'cache'
+PUSHDOWN_MODE = 'pushdown'
+DEFAULT_MAX_TERMS_COUNT = 65536
+DEFAULT_EQL_QUERY = 'any where true'
+PARSED_QUERY = 'parsed_query'
+COLUMNAR_QUERY = 'columnar_query'
+SCHEMA = 'schema'
+DEFAULT_STATE_MAX_EVENTS = 10000
+TIME_UNIT = DEFAULT_TIME_UNIT  # EQL engine ticks per second
+TIME_CACHE_SIZE = 65536
+
+
+def get_projection(paths: list):
+    """Function copying only the fields at `paths` (lists of keys) of an event."""
+    kept = []
+    for path in sorted(set(tuple(path) for path in paths), key=len):
+        # A field whose parent is kept is already copied with it
+        if not any(path[:len(parent)] == parent for parent in kept):
+            kept.append(path)
+
+    def project(event):
+        projected = {}
+        for path in kept:
+            source = event
+            for key in path[:-1]:
+                source = source.get(key) if isinstance(source, dict) else None
+            if not isinstance(source, dict) or path[-1] not in source:
+                continue
+            target = projected
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = source[path[-1]]
+        return projected
+    return project
 
 
 class BaseEnhancement(object):
@@ -16,10 +65,26 @@ class BaseEnhancement(object):
         self.client = client
         self.converter = Converter()
 
-    def process(self, alerts, enhance_params):
-        """ Modify the contents of match, a dictionary, in some way """
+    def process(self, alerts, enhance_params, rule_id=None, run=None):
+        """ Modify the contents of match, a dictionary, in some way. State changes are staged under `run` """
         raise NotImplementedError()
 
+    def can_stream(self, enhance_params) -> bool:
+        """ Check if events are enhanced one by one, so each page of hits can be processed on its own """
+        return True
+
+    def invalidate(self, enhance_params, rule_id=None):
+        """ Drop any state cached for these enhancement params (the rule was changed or removed) """
+        pass
+
+    def checkpoint(self, run=None, rule_ids=()):
+        """ Make the state staged by `run` for `rule_ids` live and persist state kept between runs """
+        pass
+
+    def discard(self, run):
+        """ Drop the state staged by a run whose alerts were not indexed """
+        pass
+
 
 class EQLEnhancement(BaseEnhancement):
     """ Enhancements that modify the match dictionary based on the EQL query that was matched """
@@ -27,42 +92,214 @@ class EQLEnhancement(BaseEnhancement):
     DEFAULT_EVENT_TYPE = "event.category"
     DEFAULT_TIMESTAMP = "@timestamp"
 
+    def __init__(self, client, sequences=None):
+        super().__init__(client)
+        # queries: { (query, schema): { parsed query, schema used to parse it } }
+        self.queries = {}
+        # aggregations: { query: EqlAggregation or None } - count/unique-only queries answered by OpenSearch
+        self.aggregations = {}
+        # filters: { query: bool } - queries made of one event query without pipes
+        self.filters = {}
+        # projections: { query: projection } - fields of the events kept by stateful queries that are saved
+        self.projections = {}
+        self.lock = threading.Lock()
+        # sequences: { rule_id: [event] } - events kept between runs by stateful queries
+        self.sequences = sequences or EqlSequenceStore()
+        self.sequences_changed = False
+        # staged: { (run, rule_id): ([event], projection) } - buffers of runs whose alerts are not indexed yet
+        self.staged = {}
+        # unbounded: { rule_id } - stateful rules already warned about having no maxspan/stateSpan
+        self.unbounded = set()
+
+
     @staticmethod
-    def _create_events(data, event_type_key, timestamp_key, date_patterns) -> list:
-        """Create EQL Events from the provided data."""
-        eql_events = list()
+    def _to_ticks(dt: datetime) -> int:
+        """Convert a datetime to the time unit of the EQL engine (used by maxspan)."""
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return int(dt.timestamp() * TIME_UNIT)
+
+
+    def _parse_iso(self, value):
+        return self._to_ticks(ts_to_datetime(value))
+
+
+    def _get_time_parser(self, data, get_time, date_patterns):
+        """Detect the timestamp format once per batch and return a cached parser for it."""
+        def parse_patterns(value):
+            for pattern in date_patterns:
+                try:
+                    return self._to_ticks(datetime.strptime(value, pattern))
+                except ValueError:
+                    continue
+            return 0
+
+        sample = next((value for value in map(get_time, data) if isinstance(value, str)), None)
+        try:
+            self._parse_iso(sample)
+            primary, fallback = self._parse_iso, parse_patterns
+        except (TypeError, ValueError, AttributeError):
+            primary, fallback = parse_patterns, self._parse_iso
+
+        @lru_cache(maxsize=TIME_CACHE_SIZE)
+        def parse(value):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return int(value * TIME_UNIT / 1000)  # epoch_millis
+            if not isinstance(value, str):
+                return 0
+            try:
+                return primary(value)
+            except (TypeError, ValueError, AttributeError):
+                try:
+                    return fallback(value)
+                except (TypeError, ValueError, AttributeError):
+                    return 0
+
+        return parse
+
+
+    def _create_events(self, data, event_type_key, timestamp_key, date_patterns):
+        """Create EQL Events lazily from the provided data."""
+        get_type = get_nested_getter(event_type_key)
+        get_time = get_nested_getter(timestamp_key)
+        parse_time = self._get_time_parser(data, get_time, date_patterns)
+        # event_types: { event type field value: EQL event type }
+        event_types = {}
 
         # create EQL Events from 'data'
         for event_data in data:
-            event_type = eql.utils.get_event_type(event_data, event_type_key)
-            event_time = eql.utils.get_event_time(event_data, timestamp_key, date_patterns)
-            eql_events.append(eql.Event(event_type, event_time, event_data))
+            type_value = get_type(event_data)
+            type_key = type_value if isinstance(type_value, str) else json.dumps(type_value, default=str)
+            if type_key not in event_types:
+                event_types[type_key] = eql.utils.get_event_type(event_data, event_type_key)
+            yield eql.Event(event_types[type_key], parse_time(get_time(event_data)), event_data)
+
+
+    def _get_cached_query(self, query, schema):
+        """Get the parsed EQL query if it was already parsed."""
+        with self.lock:
+            cached = self.queries.get(self._get_key(query, schema))
+        return cached[PARSED_QUERY] if cached else None
+
+
+    def _get_columnar_query(self, query, schema):
+        """Get the columnar form of the parsed EQL query, None if only the eql engine can run it."""
+        with self.lock:
+            cached = self.queries.get(self._get_key(query, schema))
+        return cached.get(COLUMNAR_QUERY) if cached else None
 
-        return eql_events
+
+    def _get_key(self, query, schema) -> tuple:
+        return query, json.dumps(schema, sort_keys=True)
+
+
+    def get_query(self, events, query, schema=None):
+        """Get the parsed EQL query, parsing it only once per (query, schema).
+
+        With a declared schema the query is parsed against it. Otherwise the schema is learned from
+        the events and widened with each batch until the query parses, then learning stops."""
+        key = self._get_key(query, schema)
+        with self.lock:
+            cached = self.queries.get(key)
+        if cached and cached[PARSED_QUERY] is not None:
+            return cached[PARSED_QUERY]
+
+        if schema:
+            eql_schema = eql.Schema(schema)
+        else:
+            eql_schema = eql.Schema.learn(events)
+            if cached:
+                eql_schema = cached[SCHEMA].merge(eql_schema)
+
+        parsed_query = None
+        with eql_schema:
+            try:
+                parsed_query = eql.parse_query(query, implied_any=True, implied_base=True)
+            except eql.EqlError as e:
+                openalert_logger.debug(fr'EQL enhancer error: {e}')
+                openalert_logger.debug(fr'EQL schema of events: {json.dumps(eql_schema.schema)}')
+
+        columnar_query = compile_query(parsed_query) if parsed_query is not None else None
+        with self.lock:
+            self.queries[key] = {PARSED_QUERY: parsed_query, SCHEMA: eql_schema, COLUMNAR_QUERY: columnar_query}
+        return parsed_query
+
+
+    def can_stream(self, enhance_params) -> bool:
+        """Only queries filtering events one by one run per page. Pipes and sequences need all the events."""
+        if enhance_params.get('stateful'):
+            return False
+        query = enhance_params.get('query', DEFAULT_EQL_QUERY)
+        with self.lock:
+            if query in self.filters:
+                return self.filters[query]
+
+        # The structure of the query does not depend on the schema, the default one accepts any field
+        try:
+            parsed_query = eql.parse_query(query, implied_any=True, implied_base=True)
+            is_filter = isinstance(parsed_query.first, eql.ast.EventQuery) and not parsed_query.pipes
+        except eql.EqlError:
+            is_filter = False
+        with self.lock:
+            self.filters[query] = is_filter
+        return is_filter
+
+
+    def get_aggregation(self, enhance_params):
+        """Get the OpenSearch aggregation answering the query, None if the query needs the events."""
+        if enhance_params.get('stateful') or not enhance_params.get('aggregate', True):
+            return None
+
+        query = enhance_params.get('query', DEFAULT_EQL_QUERY)
+        with self.lock:
+            if query not in self.aggregations:
+                self.aggregations[query] = plan_aggregation(query)
+            return self.aggregations[query]
+
+
+    def invalidate(self, enhance_params, rule_id=None):
+        """Drop the cached query and the sequence state of a changed/removed rule."""
+        query = enhance_params.get('query', DEFAULT_EQL_QUERY)
+        key = self._get_key(query, enhance_params.get('schema'))
+        with self.lock:
+            self.queries.pop(key, None)
+            self.aggregations.pop(query, None)
+            self.filters.pop(query, None)
+            self.projections.pop(query, None)
+        if rule_id:
+            with self.lock:
+                self.unbounded.discard(rule_id)
+                for key in [key for key in self.staged if key[1] == rule_id]:
+                    del self.staged[key]
+            if self.sequences.remove(rule_id):
+                self.sequences_changed = True
 
 
     @staticmethod
-    def _execute_query(events, query) -> list:
-        """Execute an EQL query on the provided events."""
-        schema = eql.Schema.learn(events)
+    def _execute_query(events, parsed_query, new_data=None) -> list:
+        """Execute a parsed EQL query on the provided events.
 
+        With `new_data` (ids of event data), results made only of already seen events are dropped
+        and copies of the event data are returned, so the buffered events are never modified."""
         query_result = []
+        input_data = {id(event.data) for event in events} if new_data is not None else None
         # this function is used to store the result of the query to 'query_result'
         def store_result(result):
+            if new_data is None:
+                for event in result.events:
+                    query_result.append(event.data)
+                return
+
+            result_data = [id(event.data) for event in result.events]
+            if any(data in input_data for data in result_data) and not any(data in new_data for data in result_data):
+                return
             for event in result.events:
-                query_result.append(event.data)
+                query_result.append(dict(event.data))
 
+        # Pipes keep their state in the engine, so each run gets a fresh engine built from the parsed query
         engine = eql.PythonEngine()
-        with schema:
-            try:
-                eql_query = eql.parse_query(query, implied_any=True, implied_base=True)
-                engine.add_query(eql_query)
-            except eql.EqlError as e:
-                openalert_logger.debug(fr'EQL enhancer error: {e}')
-                openalert_logger.debug(fr'EQL schema of events: {json.dumps(schema.schema)}')
-                return []
-
-            engine.add_output_hook(store_result)
+        engine.add_query(parsed_query)
+        engine.add_output_hook(store_result)
 
         # execute the query
         engine.stream_events(events)
@@ -70,21 +307,189 @@ class EQLEnhancement(BaseEnhancement):
         return query_result
 
 
+    @staticmethod
+    def _get_event_key(event):
+        meta = event.get('_meta')
+        if meta:
+            return fr'{meta.get("_index")}/{meta.get("_id")}'
+        return json.dumps(event, sort_keys=True, default=str)
+
+
+    @staticmethod
+    def _get_state_span(parsed_query, enhance_params):
+        """Get how long (seconds) events are kept between runs: the sequence maxspan or stateSpan."""
+        first = parsed_query.first
+        if isinstance(first, eql.ast.Sequence) and first.max_span is not None:
+            return first.max_span.as_milliseconds() / 1000
+        if 'stateSpan' in enhance_params:
+            return interval_to_seconds(enhance_params['stateSpan'])
+        return None
+
+
+    def _get_state_projection(self, query):
+        """Projection of the kept events when they are saved: the fields used by the query, the event type,
+        timestamp and source document. None (whole events) if the query cannot be parsed."""
+        with self.lock:
+            if query in self.projections:
+                return self.projections[query]
+
+        # The fields of the query do not depend on the schema, which may not be learned yet
+        try:
+            parsed_query = eql.parse_query(query, implied_any=True, implied_base=True)
+        except eql.EqlError:
+            parsed_query = None
+        paths = [self.DEFAULT_TIMESTAMP.split('.'), self.DEFAULT_EVENT_TYPE.split('.'), ['_meta']]
+
+        def walk(node):
+            if isinstance(node, eql.ast.Field):
+                path = [node.base]
+                for key in node.path:
+                    if not isinstance(key, str):
+                        break  # Array items are kept with their array
+                    path.append(key)
+                paths.append(path)
+            elif isinstance(node, eql.ast.BaseNode):
+                for child in node.iter_slots():
+                    walk(child)
+            elif isinstance(node, (list, tuple)):
+                for child in node:
+                    walk(child)
+
+        walk(parsed_query)
+        projection = get_projection(paths) if parsed_query is not None else None
+        with self.lock:
+            self.projections[query] = projection
+        return projection
+
+
+    def _evict(self, events, span, timestamp_key, max_events) -> list:
+        """Keep the `max_events` last events younger than `span` seconds before the newest event."""
+        timed_events = []
+        for event in events:
+            try:
+                timed_events.append((ts_to_datetime(get_nested_value(event, timestamp_key)).timestamp(), event))
+            except (TypeError, ValueError, AttributeError):
+                continue
+        if not timed_events:
+            return []
+
+        newest = max(timestamp for timestamp, _ in timed_events)
+        kept = [event for timestamp, event in timed_events if timestamp >= newest - span]
+        return kept[-max_events:]
+
+
+    def _get_buffer(self, rule_id, run) -> list:
+        """Events kept for a rule: the ones staged by earlier pages of this run, else the committed ones."""
+        with self.lock:
+            staged = self.staged.get((run, rule_id))
+        return staged[0] if staged is not None else self.sequences.get(rule_id, [])
+
+
+    def _stage(self, rule_id, run, events, projection=None):
+        """Keep the events of a run until its alerts are indexed, without `run` they are kept at once."""
+        if run is None:
+            self.sequences.set(rule_id, events, projection)
+            self.sequences_changed = True
+            return
+        with self.lock:
+            self.staged[(run, rule_id)] = (events, projection)
+
+
+    def stateful_search(self, rule_id, events, enhance_params, run=None) -> list:
+        """Run the query over the events kept from previous runs plus the new events.
+
+        Sequences can then span several scheduler windows. Only results with at least one new
+        event are returned, and events older than the maxspan are evicted after each run. The
+        events of a run are staged and only kept once checkpoint() commits the run, so a run
+        searched again after a failed send sees the same events as new."""
+        query = enhance_params.get('query', DEFAULT_EQL_QUERY)
+        max_events = enhance_params.get('stateMaxEvents', DEFAULT_STATE_MAX_EVENTS)
+        buffer = self._get_buffer(rule_id, run)
+
+        # Overlapping windows (bufferTime) fetch some events again
+        seen = {self._get_event_key(event) for event in buffer}
+        new_events = [event for event in events if self._get_event_key(event) not in seen]
+        if not new_events:
+            return []
+
+        data = sorted(buffer + new_events, key=lambda event: str(get_nested_value(event, self.DEFAULT_TIMESTAMP)))
+        eql_events = list(self._create_events(data, self.DEFAULT_EVENT_TYPE, self.DEFAULT_TIMESTAMP,
+                                              self.DEFAULT_DATE_PATTERNS))
+        parsed_query = self.get_query(eql_events, query, enhance_params.get('schema'))
+        if parsed_query is None:
+            # The learned schema may not cover the query yet, keep the events for the next run
+            self._stage(rule_id, run, data[-max_events:], self._get_state_projection(query))
+            return []
+
+        result = self._execute_query(eql_events, parsed_query, {id(event) for event in new_events})
+
+        span = self._get_state_span(parsed_query, enhance_params)
+        if span is not None:
+            self._stage(rule_id, run, self._evict(data, span, self.DEFAULT_TIMESTAMP, max_events),
+                        self._get_state_projection(query))
+        elif rule_id not in self.unbounded:
+            self.unbounded.add(rule_id)
+            openalert_logger.warning(fr'Stateful EQL query of rule: {rule_id} has no maxspan and no stateSpan, '
+                                     fr'no events are kept between runs')
+
+        return result
+
+
+    def checkpoint(self, run=None, rule_ids=()):
+        """Keep the events staged by `run` for the rules whose alerts were indexed, then persist the events kept
+        by stateful queries, so sequences survive restarts."""
+        with self.lock:
+            committed = {key[1]: self.staged.pop(key) for key in list(self.staged) if key[0] == run}
+        for rule_id in rule_ids:
+            if rule_id in committed:
+                self.sequences.set(rule_id, *committed[rule_id])
+                self.sequences_changed = True
+
+        if self.sequences_changed:
+            self.sequences_changed = False
+            self.sequences.save()
+
+
+    def discard(self, run):
+        """Drop the events staged by a run, the next run searches its window again."""
+        with self.lock:
+            for key in [key for key in self.staged if key[0] == run]:
+                del self.staged[key]
+
+
     def search(self, data, query, event_type_key=DEFAULT_EVENT_TYPE, timestamp_key=DEFAULT_TIMESTAMP,
-               date_patterns=DEFAULT_DATE_PATTERNS) -> list:
+               date_patterns=DEFAULT_DATE_PATTERNS, schema=None) -> list:
         """Perform a EQL search on the provided JSON or YAML data."""
         eql_events = self._create_events(data, event_type_key, timestamp_key, date_patterns)
 
+        # Events are only materialized when the schema has to be learned, otherwise they are streamed
+        parsed_query = self._get_cached_query(query, schema)
+        if parsed_query is None:
+            eql_events = list(eql_events)
+            parsed_query = self.get_query(eql_events, query, schema)
+            if parsed_query is None:
+                return []
+
+        # `any where ... | count ...` queries run on NumPy columns, unless the events need the eql engine
+        columnar_query = self._get_columnar_query(query, schema)
+        if columnar_query is not None:
+            match_event = columnar_query.execute(data)
+            if match_event is not None:
+                return match_event
+
         # execute the EQL query on the provided data
-        match_event = self._execute_query(eql_events, query)
+        match_event = self._execute_query(eql_events, parsed_query)
 
         return match_event
 
 
-    def process(self, events, enhance_params):
+    def process(self, events, enhance_params, rule_id=None, run=None):
+        if enhance_params.get('stateful') and rule_id:
+            return self.stateful_search(rule_id, events, enhance_params, run)
+
         # Execute ELQ query
-        query = enhance_params.get('query', 'any where true')
-        result = self.search(events, query)
+        query = enhance_params.get('query', DEFAULT_EQL_QUERY)
+        result = self.search(events, query, schema=enhance_params.get('schema'))
         if not result:
             return []
 
@@ -93,24 +498,57 @@ class EQLEnhancement(BaseEnhancement):
 
 class IndicatorMatchEnhancement(BaseEnhancement):
     """ Enhancements that modify the match dictionary based on the indicator that was matched """
+    def __init__(self, client, store=None):
+        super().__init__(client)
+        self.store = store or IndicatorStore(client)
+
     @staticmethod
-    def does_event_match_indicator(event, indicator, mapping):
-        """Check if an event matches an indicator based on the mapping."""
+    def _hashable(value):
+        """Return a hashable form of a field value, so lists/objects can be used as join keys."""
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            return json.dumps(value, sort_keys=True, default=str)
+
+
+    def _build_key(self, data, fields):
+        """Build the join key of a document from the given fields, None if a field is missing."""
+        key = []
+        for field in fields:
+            value = get_nested_value(data, field)
+            if value is None:
+                return None
+            key.append(self._hashable(value))
+        return tuple(key)
+
+
+    def build_indexes(self, indicators, mapping) -> list:
+        """Build one hash index per mapping group: [(event_fields, { key: indicator })]."""
+        indexes = []
         for group in mapping:
-            is_group_matched = True
-            for entry in group["entries"]:
-                event_val = get_nested_value(event, entry["field"])
-                indicator_val = get_nested_value(indicator,entry["value"])
+            event_fields = [entry["field"] for entry in group["entries"]]
+            indicator_fields = [entry["value"] for entry in group["entries"]]
+            index = {}
+            for indicator in indicators:
+                key = self._build_key(indicator, indicator_fields)
+                if key is not None:
+                    index.setdefault(key, indicator)
+            indexes.append((event_fields, index))
+        return indexes
+
 
-                if event_val is None or indicator_val is None or event_val != indicator_val:
-                    is_group_matched = False
-                    break
-            if is_group_matched:
-                return True  # If one group matches (OR condition)
-        return False
+    def find_indicator(self, event, indexes):
+        """Find the indicator matching an event. Entries of a group are AND, groups are OR."""
+        for event_fields, index in indexes:
+            key = self._build_key(event, event_fields)
+            if key is not None and key in index:
+                return index[key]
+        return None
 
 
-    def process(self, events, enhance_params):
+    def build_query(self, enhance_params) -> dict:
+        """Build the OpenSearch query of the indicator indices."""
         # Use match_all query if query section is empty
         query = enhance_params.get('query')
         if not query:
@@ -119,7 +557,7 @@ class IndicatorMatchEnhancement(BaseEnhancement):
             # Generate OpenSearch query
             query = self.converter.convert_query(query)
             if not query:
-                openalert_logger.error(fr'IndicatorMatchEnhancement: cannot convert query')
+                raise Exception('IndicatorMatchEnhancement: cannot convert query')
 
         # If fields exist in IndicatorMatch config
         fields = enhance_params.get('fields')
@@ -129,29 +567,88 @@ class IndicatorMatchEnhancement(BaseEnhancement):
             self.converter.add_source_require(tmp_query, fields)
             query = tmp_query
 
-        # Get data from OpenSearch
+        return query
+
+
+    @staticmethod
+    def _get_terms(event, field) -> set:
+        """Get the scalar values of an event field (list values are flattened)."""
+        value = get_nested_value(event, field)
+        return {item for item in (value if isinstance(value, list) else [value])
+                if item is not None and not isinstance(item, dict)}
+
+
+    def build_pushdown_queries(self, events, enhance_params, query) -> list:
+        """Build queries fetching only the indicators whose mapped values appear in the events.
+
+        Each mapping group gives queries with one terms filter per entry. Events are split into
+        chunks so that no terms filter exceeds maxTermsCount. The in-memory join then keeps exact
+        matches only."""
+        max_terms_count = enhance_params.get('maxTermsCount', DEFAULT_MAX_TERMS_COUNT)
+        queries = []
+
+        def add_query(indicator_fields, chunk):
+            if not chunk[0]:
+                return
+            filters = [query[QUERY]] + [{TERMS: {field: sorted(terms, key=str)}}
+                                        for field, terms in zip(indicator_fields, chunk)]
+            queries.append({**query, QUERY: {BOOL: {FILTER: filters}}})
+
+        for group in enhance_params['mapping']:
+            event_fields = [entry["field"] for entry in group["entries"]]
+            indicator_fields = [entry["value"] for entry in group["entries"]]
+            chunk = [set() for _ in event_fields]
+            for event in events:
+                values = [self._get_terms(event, field) for field in event_fields]
+                # Every entry of a group must match (AND)
+                if not all(values):
+                    continue
+                if any(len(terms | value) > max_terms_count for terms, value in zip(chunk, values)):
+                    add_query(indicator_fields, chunk)
+                    chunk = [set() for _ in event_fields]
+                for terms, value in zip(chunk, values):
+                    terms.update(value)
+            add_query(indicator_fields, chunk)
+
+        return queries
+
+
+    def pushdown_search(self, events, enhance_params) -> list:
+        """Fetch the indicators that can match the events with batched terms queries."""
+        indicators = {}
+        index = ','.join(enhance_params['index'])
+        for query in self.build_pushdown_queries(events, enhance_params, self.build_query(enhance_params)):
+            for hit in helpers.scan(self.client, query=query, index=index, size=SCAN_SIZE):
+                if hit.get('_source'):
+                    indicators[hit['_id']] = hit['_source']
+        return list(indicators.values())
+
+
+    def process(self, events, enhance_params, rule_id=None, run=None):
         try:
-            opensearch_data = self.client.search(index=','.join(enhance_params['index']), body=query)['hits']['hits']
+            if enhance_params.get('mode', CACHE_MODE) == PUSHDOWN_MODE:
+                # Fetch only the indicators sharing values with this batch of events
+                indicators = self.pushdown_search(events, enhance_params)
+                indexes = self.build_indexes(indicators, enhance_params['mapping'])
+            else:
+                # Get indicators from the shared store, OpenSearch is only queried when the feed is missing or expired
+                feed = self.store.get(enhance_params['index'], enhance_params.get('query'),
+                                      enhance_params.get('fields'), lambda: self.build_query(enhance_params))
+                indicators = feed.indicators
+                indexes = feed.get_indexes(enhance_params['mapping'], self.build_indexes)
         except Exception as e:
             openalert_logger.error(f"Cannot get data from OpenSearch. ERROR: {e}")
             return []
 
-        # Build list indicators
-        indicators = []
-        for data in opensearch_data:
-            if not data['_source']:
-                continue
-            indicators.append(data['_source'])
-
         if not indicators:
             return []
 
-        # Check if event match indicator
+        # Check if event match indicator, one hash lookup per mapping group
         match_events = []
         for event in events:
-            for indicator in indicators:
-                if self.does_event_match_indicator(event, indicator, enhance_params['mapping']):
-                    match_events.append(event)
-                    break   # Stop checking other indicators for this event
+            indicator = self.find_indicator(event, indexes)
+            if indicator is not None:
+                event[MATCHED_INDICATOR] = indicator
+                match_events.append(event)
 
         return match_events
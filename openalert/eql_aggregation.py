@@ -0,0 +1,173 @@
+import eql
+from eql.ast import PipedQuery, EventQuery, Field, Boolean
+from eql.pipes import CountPipe, UniquePipe
+from eql.schema import EVENT_TYPE_ANY
+
+from eql_columnar import remove_case, format_count_table
+from paginator import pattern_sort, TIMESTAMP, SIZE, SORT, HITS
+
+
+AGGREGATION = 'eql'
+FIRST_SEEN = 'first_seen'
+FIRST_HIT = 'first_hit'
+AFTER_KEY = 'after_key'
+DEFAULT_COMPOSITE_SIZE = 1000
+
+
+def plan_aggregation(query: str, composite_size=DEFAULT_COMPOSITE_SIZE):
+    """Plan `any where true | count [fields]` or `any where true | unique fields` as an OpenSearch aggregation.
+
+    Return None for any other query, those need the matching documents."""
+    try:
+        with eql.parser.ignore_missing_fields:
+            parsed_query = eql.parse_query(query, implied_any=True, implied_base=True)
+    except eql.EqlError:
+        return None
+
+    if not isinstance(parsed_query, PipedQuery) or not isinstance(parsed_query.first, EventQuery):
+        return None
+    first = parsed_query.first
+    if first.event_type != EVENT_TYPE_ANY or not isinstance(first.query, Boolean) or first.query.value is not True:
+        return None
+    if len(parsed_query.pipes) != 1 or type(parsed_query.pipes[0]) not in (CountPipe, UniquePipe):
+        return None
+
+    pipe = parsed_query.pipes[0]
+    fields = []
+    for argument in pipe.arguments:
+        if not isinstance(argument, Field) or not all(isinstance(key, str) for key in argument.path):
+            return None
+        fields.append('.'.join([argument.base] + argument.path))
+
+    if type(pipe) is CountPipe:
+        return CountAggregation(fields, composite_size)
+    return UniqueAggregation(fields, composite_size)
+
+
+class EqlAggregation(object):
+    """A count/unique EQL pipe answered by a composite aggregation instead of downloading the documents.
+
+    Buckets are merged case insensitively and returned in the shape of the eql engine results. The eql engine
+    keys an array as one value while terms buckets count a document once per value, so results of multi-valued
+    fields are not returned (see counts_documents_twice)."""
+    # name: key of the aggregation in the search body
+    name = AGGREGATION
+    # fallback: the rule searches the documents instead once the aggregation failed
+    fallback = True
+
+    def __init__(self, fields: list, composite_size=DEFAULT_COMPOSITE_SIZE):
+        self.fields = fields
+        self.composite_size = composite_size
+
+
+    def _sub_aggregations(self) -> dict:
+        raise NotImplementedError()
+
+
+    def build_query(self, query: dict) -> dict:
+        """Return a copy of the rule query returning only the aggregation."""
+        sources = [{fr'f{i}': {'terms': {'field': field, 'missing_bucket': True}}}
+                   for i, field in enumerate(self.fields)]
+        composite = {'composite': {SIZE: self.composite_size, 'sources': sources},
+                     'aggs': self._sub_aggregations()}
+        return {**query, SIZE: 0, 'track_total_hits': True, 'aggs': {self.name: composite}}
+
+
+    def counts_documents_twice(self, responses: list) -> bool:
+        """Check if a document fell in several buckets: with missing_bucket each document is in at least one,
+        so more bucket documents than hits means a field had several values."""
+        if not self.fields:
+            return False
+        total = responses[0][HITS]['total']['value']
+        counted = sum(bucket['doc_count'] for response in responses
+                      for bucket in response['aggregations'][self.name]['buckets'])
+        return counted > total
+
+
+    def next_query(self, query: dict, response: dict):
+        """Return the query of the next page of buckets, None after the last page."""
+        aggregation = response['aggregations'][self.name]
+        composite = query['aggs'][self.name]['composite']
+        if len(aggregation['buckets']) < composite[SIZE] or AFTER_KEY not in aggregation:
+            return None
+        composite = {**composite, 'after': aggregation[AFTER_KEY]}
+        return {**query, 'aggs': {self.name: {**query['aggs'][self.name], 'composite': composite}}}
+
+
+    def _get_key(self, bucket):
+        values = [bucket['key'][fr'f{i}'] for i in range(len(self.fields))]
+        return values[0] if len(values) == 1 else tuple(values)
+
+
+    def get_results(self, responses: list) -> list:
+        raise NotImplementedError()
+
+
+class CountAggregation(EqlAggregation):
+    """`| count [fields]`: { count, key, percent } per key, or the total count without fields."""
+    def build_query(self, query: dict) -> dict:
+        if not self.fields:
+            return {**query, SIZE: 0, 'track_total_hits': True}
+        return super().build_query(query)
+
+
+    def next_query(self, query: dict, response: dict):
+        if not self.fields:
+            return None
+        return super().next_query(query, response)
+
+
+    def _sub_aggregations(self) -> dict:
+        # The earliest event of a bucket decides which case of an insensitive key is returned
+        return {FIRST_SEEN: {'min': {'field': TIMESTAMP}}}
+
+
+    def get_results(self, responses: list) -> list:
+        if not self.fields:
+            return [{'key': 'totals', 'count': responses[0][HITS]['total']['value']}]
+
+        # groups: { insensitive key: [first seen, key, count] }
+        groups = {}
+        for response in responses:
+            for bucket in response['aggregations'][self.name]['buckets']:
+                key = self._get_key(bucket)
+                first_seen = bucket[FIRST_SEEN]['value']
+                group = groups.setdefault(remove_case(key), [first_seen, key, 0])
+                group[2] += bucket['doc_count']
+                if first_seen is not None and (group[0] is None or first_seen < group[0]):
+                    group[0], group[1] = first_seen, key
+
+        if not groups:
+            return []
+        ordered = sorted(groups.values(), key=lambda group: (group[0] is None, group[0] or 0))
+        return format_count_table({key: {'count': count} for _, key, count in ordered})
+
+
+class UniqueAggregation(EqlAggregation):
+    """`| unique fields`: the first event of each key, in event order."""
+    def _sub_aggregations(self) -> dict:
+        return {FIRST_HIT: {'top_hits': {SIZE: 1, SORT: pattern_sort}}}
+
+
+    def get_results(self, responses: list) -> list:
+        # first_hits: { insensitive key: earliest hit }
+        first_hits = {}
+        for response in responses:
+            for bucket in response['aggregations'][self.name]['buckets']:
+                hits = bucket[FIRST_HIT][HITS][HITS]
+                if not hits:
+                    continue
+                key = remove_case(self._get_key(bucket))
+                if key not in first_hits or hits[0][SORT] < first_hits[key][SORT]:
+                    first_hits[key] = hits[0]
+
+        events = []
+        for hit in sorted(first_hits.values(), key=lambda hit: hit[SORT]):
+            if not hit['_source']:
+                continue
+            event = hit['_source']
+            event.setdefault('_meta', {})
+            event['_meta']['_index'] = hit['_index']
+            event['_meta']['_id'] = hit['_id']
+            events.append(event)
+        return events
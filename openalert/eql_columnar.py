@@ -0,0 +1,310 @@
+from eql.ast import (PipedQuery, EventQuery, Field, Boolean, String, Number, Comparison, InSet, IsNull, IsNotNull,
+                     Not, And, Or)
+from eql.pipes import CountPipe
+from eql.schema import EVENT_TYPE_ANY
+from eql.utils import fold_case, is_string, is_number, is_array, is_insensitive, get_type_converter
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, queries then always run on the eql engine
+    np = None
+
+
+HOST_KEY = 'hostname'  # eql.PythonEngine default host_key, adds hosts/total_hosts to count results
+MAX_EXACT_INT = 2 ** 53  # larger ints are not exact as float64
+NULL, STRING, NUMBER, OTHER, UNKNOWN = range(5)
+KINDS = {type(None): NULL, str: STRING, int: NUMBER, float: NUMBER}  # bool is OTHER, as in eql.utils.is_number
+
+
+class Unsupported(Exception):
+    """The query or the events cannot be evaluated on columns, the eql engine has to be used."""
+
+
+def compile_query(parsed_query):
+    """Compile `any where <predicates> [| count <fields>]` to a ColumnarQuery, None for any other query."""
+    if np is None:
+        return None
+    try:
+        return ColumnarQuery(parsed_query)
+    except Unsupported:
+        return None
+
+
+def _walk_path(value, path):
+    """Get a nested field value exactly like eql.PythonEngine does."""
+    for key in path:
+        if value is None:
+            break
+        elif is_string(value) and is_string(key):
+            # expand subtype.create -> subtype == "create"
+            value = (value == key)
+        elif isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(key, int) and is_array(value) and key < len(value):
+            value = value[key]
+        else:
+            return None
+    return value
+
+
+def _get_values(data, field: Field) -> list:
+    """Get the values of a field in all events, with a fast path for nested dicts."""
+    values = [event.get(field.base) for event in data]
+    for position, key in enumerate(field.path):
+        if is_string(key):
+            values = [value.get(key) if type(value) is dict else _walk_path(value, [key]) for value in values]
+        else:
+            values = [_walk_path(value, field.path[position:]) for value in values]
+            break
+    return values
+
+
+def remove_case(key):
+    """Case insensitive form of a count/unique key, as eql.PythonEngine uses to group them."""
+    if is_string(key):
+        return fold_case(key)
+    elif is_array(key):
+        return tuple(remove_case(k) for k in key)
+    return key
+
+
+def _get_kind(value) -> int:
+    if value is None:
+        return NULL
+    if is_string(value):
+        return STRING
+    if is_number(value):
+        return NUMBER
+    return OTHER
+
+
+def format_count_table(count_table: dict) -> list:
+    """Build the results of the eql count pipe from { key: {'count': n} } in first seen order."""
+    converter = get_type_converter(count_table)
+    converted_count_table = {converter(k): v for k, v in count_table.items()}
+    total = sum(details['count'] for details in converted_count_table.values())
+
+    result = []
+    for key, details in sorted(converted_count_table.items(), key=lambda kv: (kv[1]['count'], kv[0])):
+        details['key'] = key
+        details['percent'] = float(details['count']) / total
+        result.append(details)
+    return result
+
+
+class Column(object):
+    """Values of one field over a batch. Kinds are computed once, folded strings and numbers when used."""
+    def __init__(self, values):
+        self.values = np.fromiter(values, dtype=object, count=len(values))
+        get_kind = KINDS.get
+        kinds = np.fromiter([get_kind(type(value), UNKNOWN) for value in values], dtype=np.int8, count=len(values))
+        # Subclasses of str/int/float are rare, classify them like eql does
+        for row in np.flatnonzero(kinds == UNKNOWN):
+            kinds[row] = _get_kind(values[row])
+        self.kinds = kinds
+        self._strings = None
+        self._numbers = None
+
+
+    @property
+    def strings(self):
+        """Case folded strings, empty for other kinds."""
+        if self._strings is None:
+            is_string_kind = self.kinds == STRING
+            strings = np.full(len(self.kinds), '', dtype=object)
+            values = self.values[is_string_kind]
+            strings[is_string_kind] = [value.lower() for value in values] if is_insensitive() else values
+            self._strings = strings.astype(str)
+        return self._strings
+
+
+    @property
+    def numbers(self):
+        """Numbers as float64, NaN for other kinds."""
+        if self._numbers is None:
+            is_number_kind = self.kinds == NUMBER
+            numbers = np.full(len(self.kinds), np.nan)
+            numbers[is_number_kind] = self.values[is_number_kind].astype(np.float64)
+            if np.any(np.abs(numbers[is_number_kind]) > MAX_EXACT_INT):
+                raise Unsupported()
+            self._numbers = numbers
+        return self._numbers
+
+
+    def factorize(self, rows) -> np.ndarray:
+        """Codes of the case insensitive values of the rows, equal values (as dict keys) get equal codes."""
+        kinds = self.kinds[rows]
+        if np.all(kinds == STRING):
+            return np.unique(self.strings[rows], return_inverse=True)[1]
+        if np.all(kinds == NUMBER):
+            return np.unique(self.numbers[rows], return_inverse=True, equal_nan=False)[1]
+
+        table = {}
+        return np.array([table.setdefault(remove_case(value), len(table)) for value in self.values[rows]])
+
+
+class Batch(object):
+    """Events of one search, fields are extracted to columns once and only when used."""
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.columns = {}
+
+
+    def get_column(self, field: Field) -> Column:
+        key = (field.base, tuple(field.path))
+        if key not in self.columns:
+            self.columns[key] = Column(_get_values(self.data, field))
+        return self.columns[key]
+
+
+class ColumnarQuery(object):
+    """A simple EQL query evaluated on a batch of events with NumPy.
+
+    Predicates are evaluated as (true, null) masks with the three-valued logic, type checks and case folding
+    of eql.PythonEngine, so the results are identical. Anything the columns cannot express exactly raises
+    Unsupported, at compile time for the query or at run time for the events."""
+    def __init__(self, parsed_query):
+        if not isinstance(parsed_query, PipedQuery) or not isinstance(parsed_query.first, EventQuery):
+            raise Unsupported()
+        if parsed_query.first.event_type != EVENT_TYPE_ANY or len(parsed_query.pipes) > 1:
+            raise Unsupported()
+
+        self.where = self._convert(parsed_query.first.query)
+        self.count_fields = None
+        if parsed_query.pipes:
+            pipe = parsed_query.pipes[0]
+            if type(pipe) is not CountPipe or not all(isinstance(arg, Field) for arg in pipe.arguments):
+                raise Unsupported()
+            self.count_fields = pipe.arguments
+
+
+    def _convert(self, node):
+        """Convert a predicate to a callback returning its (true, null) masks over a batch."""
+        if isinstance(node, Boolean):
+            return lambda batch: (np.full(batch.size, bool(node.value)), np.zeros(batch.size, dtype=bool))
+
+        if isinstance(node, Comparison):
+            get_left = self._convert_operand(node.left)
+            get_right = self._convert_operand(node.right)
+            compare = node.function
+
+            def comparison(batch):
+                left, right = get_left(batch), get_right(batch)
+                # type(a) == type(b) comparisons of other values (bool, list, object) are left to eql
+                if np.any((left.kinds == OTHER) & (right.kinds == OTHER)):
+                    raise Unsupported()
+                strings = (left.kinds == STRING) & (right.kinds == STRING)
+                numbers = (left.kinds == NUMBER) & (right.kinds == NUMBER)
+                true = (strings & compare(left.strings, right.strings)) | \
+                       (numbers & compare(left.numbers, right.numbers))
+                return true, ~(strings | numbers)
+
+            return comparison
+
+        if isinstance(node, InSet):
+            if not node.is_literal():
+                raise Unsupported()
+            values = {fold_case(item.value) for item in node.container}
+            if any(isinstance(value, bool) for value in values):
+                raise Unsupported()
+            strings = [value for value in values if is_string(value)]
+            numbers = [value for value in values if is_number(value)]
+            if any(abs(value) > MAX_EXACT_INT for value in numbers):
+                raise Unsupported()
+            get_column = self._convert_operand(node.expression)
+
+            def in_set(batch):
+                column = get_column(batch)
+                if np.any(column.kinds == OTHER):
+                    raise Unsupported()
+                true = np.zeros(batch.size, dtype=bool)
+                if strings:
+                    true |= (column.kinds == STRING) & np.isin(column.strings, strings)
+                if numbers:
+                    true |= (column.kinds == NUMBER) & np.isin(column.numbers, numbers)
+                return true, column.kinds == NULL
+
+            return in_set
+
+        if isinstance(node, (IsNull, IsNotNull)):
+            get_column = self._convert_operand(node.expr)
+            expected = isinstance(node, IsNull)
+            return lambda batch: ((get_column(batch).kinds == NULL) == expected,
+                                  np.zeros(batch.size, dtype=bool))
+
+        if isinstance(node, Not):
+            get_term = self._convert(node.term)
+
+            def negate(batch):
+                true, null = get_term(batch)
+                return ~true & ~null, null
+
+            return negate
+
+        if isinstance(node, (And, Or)):
+            get_terms = [self._convert(term) for term in node.terms]
+            is_and = isinstance(node, And)
+
+            def compound(batch):
+                decided = np.zeros(batch.size, dtype=bool)
+                null = np.zeros(batch.size, dtype=bool)
+                for get_term in get_terms:
+                    true, term_null = get_term(batch)
+                    # And is decided by a false term, Or by a true term, otherwise null wins
+                    decided |= (~true & ~term_null) if is_and else true
+                    null |= term_null
+                null &= ~decided
+                return (~decided & ~null if is_and else decided), null
+
+            return compound
+
+        raise Unsupported()
+
+
+    @staticmethod
+    def _convert_operand(node):
+        if isinstance(node, Field):
+            return lambda batch: batch.get_column(node)
+        if isinstance(node, (String, Number)):
+            # A single row column, broadcast against the field columns
+            column = Column([node.value])
+            return lambda batch: column
+        raise Unsupported()
+
+
+    def execute(self, data) -> list:
+        """Run the query on a list of event data. Return None if the events need the eql engine."""
+        batch = Batch(data)
+        try:
+            true, _ = self.where(batch)
+            rows = np.flatnonzero(np.broadcast_to(true, batch.size))
+            if self.count_fields is None:
+                return [data[row] for row in rows]
+            if any(HOST_KEY in data[row] for row in rows):
+                raise Unsupported()
+            if not self.count_fields:
+                return [{'key': 'totals', 'count': len(rows)}]
+            return self._count(batch, rows)
+        except (Unsupported, TypeError):
+            return None
+
+
+    def _count(self, batch, rows) -> list:
+        """Count the rows by key like the eql count pipe: insensitive keys, first seen case, sorted by count."""
+        if not len(rows):
+            return []
+
+        columns = [batch.get_column(field) for field in self.count_fields]
+        codes = [column.factorize(rows) for column in columns]
+        keys = codes[0] if len(codes) == 1 else np.column_stack(codes)
+        _, first, counts = np.unique(keys, axis=0, return_index=True, return_counts=True)
+
+        # Same table as the eql engine: keys in first seen order, with the case of the first event
+        count_table = {}
+        for group in np.argsort(first):
+            row = rows[first[group]]
+            key = columns[0].values[row] if len(columns) == 1 else tuple(column.values[row] for column in columns)
+            count_table[key] = {'count': int(counts[group])}
+
+        return format_count_table(count_table)
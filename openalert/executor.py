@@ -1,67 +1,104 @@
-import copy
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
 from typing import Dict
 from apscheduler.schedulers.background import BackgroundScheduler
 
 import actions
+from alert import Alert, RuleMetadata, RULE_ID, TIMESTAMP, INDEX, ID
+from bulk_writer import BulkWriter
 from rule import RuleManager
-from converter import Converter, QUERY, BOOL, MUST_NOT
+from converter import Converter, QUERY, BOOL, FILTER, OPEN_SEARCH_AGGREGATION
 from logger import openalert_logger
 from opensearch_client import OpenSearchClient
-from enhancements import EQLEnhancement, IndicatorMatchEnhancement
-from ultils import ts_now, interval_to_seconds
-from watcher import RulesWatcher, ExceptionsWatcher
-
-
-METADATA = '_metadata'
-INDEX = '_index'
-ID = '_id'
-RULE = 'rule'
-RULE_NAME = 'name'
-RULE_ID = 'id'
-RULE_DESCRIPTION = 'description'
-RISK_SCORE = 'risk_score'
-SEVERITY_LABEL = 'severity_label'
-RULE_TAGS = 'tags'
-RULE_THREAT = 'threat'
-EVENT = 'event'
-TIMESTAMP = '@timestamp'
-MATCH = 'match'
-CREATED = 'created'
+from paginator import HitPaginator, DEFAULT_PAGE_SIZE, DEFAULT_KEEP_ALIVE
+from enhancements import EQLEnhancement, IndicatorMatchEnhancement, MATCHED_INDICATOR
+from threshold import ThresholdAggregation
+from indicator_store import IndicatorStore
+from state import WatermarkStore, EqlSequenceStore, ConversionCache, SuppressionStore, DEFAULT_STATE_FOLDER
+from suppression import Suppressor
+from ultils import ts_now, ts_to_datetime, interval_to_seconds
+from watcher import RulesWatcher, ExceptionsWatcher, DEFAULT_DEBOUNCE
 
-pattern_alert = {
-    TIMESTAMP: '',
-    METADATA: {INDEX: '', ID: ''},
-    RULE: {RULE_NAME: '', RULE_ID: '', RULE_DESCRIPTION: '',
-           RISK_SCORE: 0, SEVERITY_LABEL: '', RULE_TAGS: [], RULE_THREAT: []},
-    EVENT:{MATCH: {}}
-}
 
+CREATED = 'created'
+RANGE = 'range'
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MSEARCH_BATCH_SIZE = 100
+DEFAULT_MSEARCH_CONCURRENCY = 4
+DATE_FORMAT = 'strict_date_optional_time'
+DEFAULT_MAX_CATCHUP = '24h'
 
 class Executor(RuleManager):
     def __init__(self, rules, disabled_rules, exceptions, config):
         super().__init__(rules, disabled_rules, exceptions)
         self.rules_folder = config['rule']['rulesFolder']
         self.exceptions_folder = config['rule']['exceptionsFolder']
-        self.rules_watcher = RulesWatcher(self.rules_folder, self)
-        self.exceptions_watcher = ExceptionsWatcher(self.exceptions_folder,self)
-        self.converter = Converter()
+        # File events are coalesced for reloadDebounce seconds and applied as one batch
+        self.reloadDebounce = config['rule'].get('reloadDebounce', DEFAULT_DEBOUNCE)
+        self.rules_watcher = RulesWatcher(self.rules_folder, self, self.reloadDebounce)
+        self.exceptions_watcher = ExceptionsWatcher(self.exceptions_folder, self, self.reloadDebounce)
 
 
         self.debug = config.get("debug", False)
         self.client = OpenSearchClient(config)
         self.writeBackIndex = config['opensearch']['writeBack']
+        # Alerts are indexed by a background writer unless opensearch.bulk.background is false
+        bulk_config = config['opensearch'].get('bulk', {})
+        self.bulk_writer = None
+        if bulk_config.get('background', True):
+            self.bulk_writer = BulkWriter(self.client, self.writeBackIndex, bulk_config)
         self.interval = config['rule']['schedule']['interval']
         self.bufferTime = config['rule']['schedule']['bufferTime']
+        # A rule behind its watermark (failures, downtime) searches at most maxCatchup back
+        self.maxCatchup = config['rule']['schedule'].get('maxCatchup', DEFAULT_MAX_CATCHUP)
         self.maxSignals = config['rule']['maxSignals']
+        self.paginator = HitPaginator(self.client, config['rule'].get('pageSize', DEFAULT_PAGE_SIZE),
+                                      config['rule'].get('pitKeepAlive', DEFAULT_KEEP_ALIVE))
+
+        self.indicatorCache = config.get('indicatorCache', {})
+
+        # watermarks: { rule_id: last successful window end }
+        self.stateFolder = config.get('state', {}).get('folder', DEFAULT_STATE_FOLDER)
+        self.watermarks = WatermarkStore(self.stateFolder)
+
+        # Suppression windows of the rules, kept across restarts with state.suppression
+        self.suppressor = Suppressor(SuppressionStore(self.stateFolder,
+                                                      config.get('state', {}).get('suppression', False)))
+
+        # Unchanged rules/exceptions reuse their Sigma conversion from previous runs
+        conversion_cache = None
+        if config.get('state', {}).get('conversionCache', True):
+            conversion_cache = ConversionCache(self.stateFolder)
+        self.converter = Converter(conversion_cache)
+        self.startupWorkers = config['rule'].get('startupWorkers', 1)
+
+        # Post-processing (paging, enhancements, alerts, actions) of the rules in a group runs in parallel
+        self.workers = ThreadPoolExecutor(max_workers=config['rule'].get('maxWorkers', DEFAULT_MAX_WORKERS),
+                                          thread_name_prefix='rule_worker')
+
+        # Rules of a group are searched in msearch batches, several batches in flight at once
+        self.msearchBatchSize = config['rule'].get('msearchBatchSize', DEFAULT_MSEARCH_BATCH_SIZE)
+        self.maxConcurrentSearches = config['rule'].get('maxConcurrentSearches')
+        self.search_workers = self._create_search_workers(config)
+
+        # aggregation_failures: { rule_id } - rules whose EQL aggregation failed, they search documents instead
+        self.aggregation_failures = set()
+
+        # rule_metadata: { rule_id: RuleMetadata } - rule block shared by the alerts of the current rule version
+        self.rule_metadata = {}
 
         # jobs: { interval: job_id }
         self.jobs: Dict[int, str] = {}
         self.jobs_lock = threading.Lock()
-        self.scheduler = BackgroundScheduler()
+        self.scheduler = self._create_scheduler()
 
         openalert_logger.info('Pre-processing rules and exceptionsList...')
         self.preprocess()
+        self.index_all()
+        self.compile_all_queries()
+        self.publish()
 
         openalert_logger.info('Loading enhancer...')
         self.enhancers = {}
@@ -72,62 +109,92 @@ class Executor(RuleManager):
         self.load_actions()
 
 
+    def _create_search_workers(self, config):
+        """Pool sending the msearch batches of a group concurrently."""
+        return ThreadPoolExecutor(max_workers=config['rule'].get('msearchConcurrency', DEFAULT_MSEARCH_CONCURRENCY),
+                                  thread_name_prefix='msearch_worker')
+
+
+    def _create_scheduler(self):
+        """Scheduler running the rule group jobs."""
+        return BackgroundScheduler()
+
+
     def preprocess(self):
         """Build OpenSearch query for Rule and ExceptionsList"""
         # Get DSL_Lucene query from Rule
-        self.rules = self.converter.convert_all(self.rules, 'rules')
+        self.rules = self.converter.convert_all(self.rules, 'rules', self.startupWorkers)
 
         # Get DSL_Lucene query from DisabledRule
-        self.disabled_rules = self.converter.convert_all(self.disabled_rules, 'rules')
+        self.disabled_rules = self.converter.convert_all(self.disabled_rules, 'rules', self.startupWorkers)
 
         # Get DSL_Lucene query from ExceptionsList
-        self.exceptions = self.converter.convert_all(self.exceptions, 'exceptionsList')
+        self.exceptions = self.converter.convert_all(self.exceptions, 'exceptionsList', self.startupWorkers)
 
         openalert_logger.info(r"Pre-processing completed. enabledRules: {}, exceptionsList: {}, disabledRules: {}".format(
             len(self.rules), len(self.exceptions), len(self.disabled_rules)))
 
+        self.converter.save_cache(prune=True)
+        if self.converter.cache is not None:
+            openalert_logger.info(fr'Conversion cache: {self.converter.cache.stats()}')
+
 
     def load_enhancer(self):
         """Load enhancer."""
-        self.enhancers['eql'] = EQLEnhancement(self.client)
-        self.enhancers['indicatorMatch'] = IndicatorMatchEnhancement(self.client)
+        self.enhancers['eql'] = EQLEnhancement(self.client, EqlSequenceStore(self.stateFolder))
+        self.enhancers['indicatorMatch'] = IndicatorMatchEnhancement(self.client,
+                                                                     IndicatorStore(self.client, self.indicatorCache))
         openalert_logger.info(fr'Enhancer loaded successfully. Enhancers: {list(self.enhancers.keys())}')
 
 
+    def invalidate_enhancers(self, rule):
+        """Drop the enhancer state cached for a changed/removed rule."""
+        self.aggregation_failures.discard(rule[RULE_ID])
+        self.rule_metadata.pop(rule[RULE_ID], None)
+        for enhancement in rule.get('enhancements', []):
+            enhancer = next(iter(enhancement))
+            if enhancer in self.enhancers:
+                self.enhancers[enhancer].invalidate(enhancement[enhancer], rule[RULE_ID])
+
+
     def load_actions(self):
         """Load actions."""
         self.actions['debug'] = actions.DebugAction()
-        self.actions['indexer'] = actions.IndexerAction()
+        self.actions['indexer'] = actions.IndexerAction(self.bulk_writer)
         self.actions['email'] = actions.EmailAction()
         openalert_logger.info(fr'Actions loaded successfully. Actions: {list(self.actions.keys())}')
 
 
-    def _build_alerts(self, rule, events):
+    def _get_rule_metadata(self, rule) -> RuleMetadata:
+        """Get the shared alert metadata of a rule, rebuilt when the rule is reloaded."""
+        metadata = self.rule_metadata.get(rule[RULE_ID])
+        if metadata is None or metadata.rule is not rule:
+            metadata = RuleMetadata(rule)
+            self.rule_metadata[rule[RULE_ID]] = metadata
+        return metadata
+
+
+    def _build_alerts(self, rule, events, timestamp=None):
         """Helper method to add match events to alerts."""
         max_signals = rule.get('maxSignals', self.maxSignals)
+        metadata = self._get_rule_metadata(rule)
+        # Suppression windows of a run are staged until its alerts are indexed
+        run = timestamp
+        timestamp = timestamp or ts_now()
+        # Suppressed duplicates must not use maxSignals, all events are turned into alerts first
+        suppression = 'suppression' in rule
         alerts = []
-        for index, event in enumerate(events):
-            alert = copy.deepcopy(pattern_alert)
-            alert[TIMESTAMP] = ts_now()
-            alert[RULE][RULE_NAME] = rule[RULE_NAME]
-            alert[RULE][RULE_ID] = rule[RULE_ID]
-            alert[RULE][RULE_DESCRIPTION] = rule[RULE_DESCRIPTION]
-            alert[RULE][RISK_SCORE] = rule['riskScore']
-            alert[RULE][SEVERITY_LABEL] = rule['severity']
-            alert[RULE][RULE_TAGS] = rule[RULE_TAGS]
-            alert[RULE][RULE_THREAT] = rule[RULE_THREAT]
+        for event in (events if suppression else events[:max(max_signals, 1)]):
+            index = id = indicator = None
             if '_meta' in event:
                 _meta = event.pop('_meta')
-                alert[METADATA][INDEX] = _meta[INDEX]
-                alert[METADATA][ID] = _meta[ID]
-            else:
-                alert.pop(METADATA)
-            alert[EVENT][MATCH] = event
-            alerts.append(alert)
-
-            if index >= max_signals - 1:
-                break
+                index, id = _meta[INDEX], _meta[ID]
+            if MATCHED_INDICATOR in event:
+                indicator = event.pop(MATCHED_INDICATOR)
+            alerts.append(Alert(timestamp, metadata, event, index, id, indicator))
 
+        if suppression:
+            alerts = self.suppressor.apply(rule, metadata, alerts, timestamp, max(max_signals, 1), run)
         return alerts
 
 
@@ -147,90 +214,250 @@ class Executor(RuleManager):
         return events
 
 
-    def _add_exceptions_to_query(self, query: dict, exceptions_list: list):
-        """Helper method to add exceptions to a query's MUST_NOT clause."""
-        for exc_id in exceptions_list:
-            for exception in self.exceptions.values():
-                if exception['id'] != exc_id:
+    def _get_time_window(self, rule, now: datetime):
+        """Get the time window of a rule: [last_end or now - interval] - bufferTime to now.
+
+        The start is never older than maxCatchup, the events of a longer gap are skipped."""
+        schedule = rule.get('schedule', {})
+        interval = timedelta(seconds=interval_to_seconds(schedule.get('interval', self.interval)))
+        buffer_time = timedelta(seconds=interval_to_seconds(schedule.get('bufferTime', self.bufferTime)))
+        max_catchup = timedelta(seconds=interval_to_seconds(schedule.get('maxCatchup', self.maxCatchup)))
+
+        start = now - interval
+        last_end = self.watermarks.get(rule[RULE_ID])
+        if last_end:
+            start = min(start, ts_to_datetime(last_end))
+        if start < now - max_catchup:
+            openalert_logger.warning(fr'Rule: {rule["name"]} is behind its watermark by more than maxCatchup, '
+                                     fr'events from {start.isoformat()} to {(now - max_catchup).isoformat()} '
+                                     fr'are skipped')
+            start = now - max_catchup
+
+        return start - buffer_time, now
+
+
+    @staticmethod
+    def _add_time_range_to_query(query: dict, start: datetime, end: datetime) -> dict:
+        """Return a copy of the query restricted to [start, end] on @timestamp."""
+        time_range = {RANGE: {TIMESTAMP: {'gte': start.isoformat(), 'lte': end.isoformat(), 'format': DATE_FORMAT}}}
+        bool_query = {**query[QUERY][BOOL], FILTER: query[QUERY][BOOL][FILTER] + [time_range]}
+        return {**query, QUERY: {**query[QUERY], BOOL: bool_query}}
+
+
+    def _run_enhancements(self, rule, events, run=None):
+        """Run the enhancements of a rule over a batch of events. Their state changes are staged under `run`."""
+        for enhancement in rule.get('enhancements', []):
+            enhancer = next(iter(enhancement))
+            if not events:
+                openalert_logger.debug(fr'Enhancement process has been stopped. Events are not available to run enhancer: {enhancer}')
+                break
+            events = self.enhancers[enhancer].process(events, enhancement[enhancer], rule[RULE_ID], run)
+
+        return events
+
+
+    def _collect_events(self, rule, query, response, run=None):
+        """Page through the hits of a rule and enhance each page until maxSignals events are kept.
+
+        Enhancements that need all the events (EQL pipes, sequences, stateful queries) run once on every
+        page of the window instead."""
+        max_signals = rule.get('maxSignals', self.maxSignals)
+        streaming = all(self.enhancers[name].can_stream(params)
+                        for enhancement in rule.get('enhancements', []) for name, params in enhancement.items())
+        events = []
+        with closing(self.paginator.pages(rule['index'], query, response)) as pages:
+            for hits in pages:
+                page_events = self._build_events(hits)
+                if not page_events:
+                    continue
+                if not streaming:
+                    events.extend(page_events)
                     continue
-                query_section = exception.get('OpenSearchQuery', {})
-                query[QUERY][BOOL][MUST_NOT].extend(
-                    query_section.get(QUERY, {}).get(BOOL, {}).get(MUST_NOT, [])
-                )
 
+                events.extend(self._run_enhancements(rule, page_events, run))
+                if len(events) >= max_signals:
+                    break
 
-    def run_rule_group(self, interval: int):
-        """Run all rules in a group."""
-        openalert_logger.info(fr'Running rule group: {interval}...')
-        rules = self.grouped_rules.get(interval, {})
+        if not streaming and events:
+            events = self._run_enhancements(rule, events, run)
+        return events
 
-        # Prepare OpenSearch multi-search body
-        msearch_body = []
-        for rule in rules.values():
-            query = rule.get('OpenSearchQuery')
-            # Add exceptions to the query
-            if 'exceptionsList' in rule:
-                self._add_exceptions_to_query(query, rule['exceptionsList'])
 
-            # Add rule to the multi-search body
+    def _get_aggregation(self, rule):
+        """Get the aggregation of a threshold rule, or of a rule whose only enhancement is a count/unique EQL query."""
+        if OPEN_SEARCH_AGGREGATION in rule:
+            return ThresholdAggregation(rule)
+        if rule[RULE_ID] in self.aggregation_failures:
+            return None
+        enhancements = rule.get('enhancements', [])
+        if len(enhancements) != 1 or 'eql' not in enhancements[0]:
+            return None
+        return self.enhancers['eql'].get_aggregation(enhancements[0]['eql'])
+
+
+    def _collect_aggregation(self, rule, aggregation, query, response):
+        """Page through the buckets of a threshold rule or an aggregating EQL enhancement and return its results."""
+        responses = [response]
+        query = aggregation.next_query(query, response)
+        while query:
+            response = self.client.search(index=','.join(rule['index']), body=query)
+            responses.append(response)
+            query = aggregation.next_query(query, response)
+
+        if aggregation.fallback and aggregation.counts_documents_twice(responses):
+            # The window is searched again with documents by the next run
+            self.aggregation_failures.add(rule[RULE_ID])
+            raise Exception(fr'EQL aggregation of rule: {rule["name"]} has multi-valued fields, using documents')
+        return aggregation.get_results(responses)
+
+
+    def _msearch(self, searches) -> list:
+        """Send one multi-search request for a batch of (rule, query, aggregation) and return its responses."""
+        msearch_body = []
+        for rule, query, _ in searches:
             msearch_body.extend([
                 {"index": rule['index']},
                 query
             ])
 
-        # Get data from OpenSearch
-        try:
-            opensearch_data = self.client.msearch(msearch_body)
-        except Exception as e:
-            openalert_logger.error(f"Cannot get data from OpenSearch. ERROR: {e}")
-            return
+        params = {}
+        if self.maxConcurrentSearches:
+            params['max_concurrent_searches'] = self.maxConcurrentSearches
+        return self.client.msearch(msearch_body, params=params)['responses']
 
-        # Create alerts
-        group_alerts = []
-        for index, (filename, rule) in enumerate(rules.items()):
-            print(filename)
-            hits = opensearch_data['responses'][index]['hits']['hits']
 
-            # Should be use multi-thread for each rule
-            events = self._build_events(hits)
-            if not events:
-                openalert_logger.debug(f"No events found for rule: {rule['name']}")
-                continue
+    def _process_rule(self, rule, query, response, timestamp=None, aggregation=None) -> list:
+        """Collect events, build alerts and execute actions of one rule. Run in the worker pool.
 
-            # Run enhancements
-            if 'enhancements' in rule:
-                for enhancement in rule['enhancements']:
-                    enhancer = next(iter(enhancement))
-                    if not events:
-                        openalert_logger.debug(fr'Enhancement process has been stopped. Events are not available to run enhancer: {enhancer}')
-                        break
-                    events = self.enhancers[enhancer].process(events, enhancement[enhancer])
+        The run timestamp also identifies the state staged by the run until its alerts are indexed."""
+        timestamp = timestamp or ts_now()
+        if aggregation is not None:
+            events = self._collect_aggregation(rule, aggregation, query, response)
+        else:
+            events = self._collect_events(rule, query, response, timestamp)
+        # Suppression windows expiring without new events still emit their roll-up alert
+        if not events and 'suppression' not in rule:
+            openalert_logger.debug(fr'No event match for rule: {rule["name"]}')
+            return []
+
+        # Build alerts for rule
+        rule_alerts = self._build_alerts(rule, events, timestamp)
+        if not rule_alerts:
+            openalert_logger.debug(f"No alerts found for rule: {rule['name']}")
+            return []
+
+        # Execute actions on Rule
+        if self.debug:
+            self.actions['debug'].send(rule_alerts)
+            return rule_alerts
 
-            if not events:
-                openalert_logger.debug(fr'No event match after running enhancements for rule: {rule["name"]}')
+        for action in rule.get('actions', []):
+            action_name = list(action.keys())[0]  # Lấy tên action (key)
+            if action_name in self.actions:
+                self.actions[action_name].send(rule_alerts, action[action_name])
+
+        return rule_alerts
+
+
+    def _prepare_searches(self, interval: int):
+        """Build the (rule, query, aggregation) searches of a group and the window end of each rule.
+
+        aggregation: the EqlAggregation the query was built with, None for searches of documents."""
+        # One consistent version of the group for the whole run, reloads publish a new snapshot meanwhile
+        snapshot = self.get_group_snapshot(interval)
+        if not snapshot:
+            return [], {}
+        openalert_logger.debug(fr'Rule group: {interval}, version: {snapshot.version}, rules: {len(snapshot.rules)}')
+        now = datetime.now(timezone.utc)
+
+        searches = []
+        window_ends = {}
+        for file_path, rule, query in snapshot.rules:
+            # Final query (rule query + exceptionsList) is compiled when the rule/exception changes
+            if not query:
                 continue
 
-            # Build alerts for rule
-            rule_alerts = self._build_alerts(rule, events)
-            if not rule_alerts:
-                openalert_logger.debug(f"No alerts found for rule: {rule['name']}")
+            # Only search new data since the last successful run
+            start, end = self._get_time_window(rule, now)
+            query = self._add_time_range_to_query(query, start, end)
+            window_ends[rule[RULE_ID]] = end
+
+            # Threshold rules and count/unique-only EQL enhancements get buckets from OpenSearch, not documents
+            aggregation = self._get_aggregation(rule)
+            if aggregation:
+                searches.append((rule, aggregation.build_query(query), aggregation))
                 continue
 
-            # Append alerts of rule into group alerts
-            group_alerts.extend(rule_alerts)
+            # Rules without enhancements never need more hits than maxSignals
+            size = self.paginator.page_size if 'enhancements' in rule else rule.get('maxSignals', self.maxSignals)
+            query = self.paginator.prepare_query(query, size)
+            searches.append((rule, query, None))
+
+        return searches, window_ends
+
+
+    def _split_batches(self, searches: list) -> list:
+        """Split the searches of a group into msearch batches."""
+        return [searches[i:i + self.msearchBatchSize] for i in range(0, len(searches), self.msearchBatchSize)]
+
+
+    def _is_response_valid(self, rule, aggregation, response, window_ends: dict) -> bool:
+        """Check one msearch response. A failed rule keeps its previous watermark."""
+        if 'error' in response:
+            openalert_logger.error(fr'Cannot get data of rule: {rule["name"]}. ERROR: {response["error"]}')
+            window_ends.pop(rule[RULE_ID], None)
+            if aggregation is not None and aggregation.fallback:
+                # e.g. a text field cannot be aggregated, the window is searched again with documents
+                openalert_logger.warning(fr'EQL aggregation of rule: {rule["name"]} failed, using documents')
+                self.aggregation_failures.add(rule[RULE_ID])
+            return False
+        return True
+
 
-            # Execute actions on Rule
-            if self.debug:
-                self.actions['debug'].send(rule_alerts)
+    def run_rule_group(self, interval: int):
+        """Run all rules in a group."""
+        openalert_logger.info(fr'Running rule group: {interval}...')
+        searches, window_ends = self._prepare_searches(interval)
+        if not searches:
+            return
+
+        # Get data from OpenSearch, batches of rules are searched concurrently
+        batches = self._split_batches(searches)
+        batch_futures = [self.search_workers.submit(self._msearch, batch) for batch in batches]
+
+        # Create alerts, each rule is processed by the worker pool as soon as its batch returns
+        # All alerts of a run share one timestamp
+        timestamp = ts_now()
+        rule_futures = []
+        for batch, batch_future in zip(batches, batch_futures):
+            try:
+                responses = batch_future.result()
+            except Exception as e:
+                openalert_logger.error(f"Cannot get data from OpenSearch. ERROR: {e}")
+                for rule, _, _ in batch:
+                    window_ends.pop(rule[RULE_ID], None)
                 continue
 
-            for action in rule['actions']:
-                action_name = list(action.keys())[0]  # Lấy tên action (key)
-                if action_name in self.actions:
-                    self.actions[action_name].send(rule_alerts, action[action_name])
+            for (rule, query, aggregation), response in zip(batch, responses):
+                if self._is_response_valid(rule, aggregation, response, window_ends):
+                    rule_futures.append((rule, self.workers.submit(self._process_rule, rule, query, response,
+                                                                   timestamp, aggregation)))
 
+        # Merge results in rule order
+        group_alerts = []
+        for rule, future in rule_futures:
+            try:
+                group_alerts.extend(future.result())
+            except Exception as e:
+                openalert_logger.error(fr'Cannot process rule: {rule["name"]}. ERROR: {e}')
+                window_ends.pop(rule[RULE_ID], None)
 
         if self.debug:
+            self._commit_watermarks(window_ends, timestamp)
+            return
+
+        if self.bulk_writer is not None:
+            self._queue_alerts(interval, group_alerts, window_ends, timestamp)
             return
 
         # Use the Bulk API to send all alerts to OpenSearch.
@@ -239,10 +466,53 @@ class Executor(RuleManager):
             'index': self.writeBackIndex
         }
         response = self.actions['indexer'].send(group_alerts, opensearch_config)
+        self._on_alerts_sent(interval, response, window_ends, timestamp)
+
+
+    def _queue_alerts(self, interval: int, alerts: list, window_ends: dict, run=None):
+        """Hand the alerts of a group to the background writer. Watermarks move once all of them are indexed."""
+        def on_written(success, errors):
+            if errors:
+                openalert_logger.error(fr'{len(errors)} alerts of rules_group_{interval} were not indexed. '
+                                       fr'ERROR: {errors[0]}')
+            self._on_alerts_sent(interval, None if errors else (success, errors), window_ends, run)
+
+        self.actions['indexer'].send(alerts, {'callback': on_written})
+
+
+    def _on_alerts_sent(self, interval: int, response, window_ends: dict, run=None):
+        """Log the bulk result of a group and move the watermarks forward if it succeeded."""
         if response:
-            openalert_logger.info(f"Sent {response[0]} alerts of rules_group_{interval} to Indexer.")
+            queue_depth = fr' Queue depth: {self.bulk_writer.queue_depth()}' if self.bulk_writer else ''
+            openalert_logger.info(f"Sent {response[0]} alerts of rules_group_{interval} to Indexer.{queue_depth}")
+            self._commit_watermarks(window_ends, run)
         else:
             openalert_logger.error(f"Failed to send alerts of rules_group_{interval} to Indexer.")
+            self._discard_run(run)
+
+
+    def _discard_run(self, run):
+        """Drop the state staged by a run whose alerts were not indexed, its windows are searched again."""
+        for enhancer in self.enhancers.values():
+            enhancer.discard(run)
+        self.suppressor.discard(run)
+
+
+    def _commit_watermarks(self, window_ends: dict, run=None):
+        """Persist the window end of successfully processed rules and commit the state staged by their run."""
+        for rule_id, end in window_ends.items():
+            # Background writes of successive runs may complete out of order, never move a watermark back
+            last_end = self.watermarks.get(rule_id)
+            if last_end and ts_to_datetime(last_end) >= end:
+                continue
+            self.watermarks.set(rule_id, end.isoformat())
+        self.watermarks.save()
+
+        # Enhancer state (e.g. EQL sequences) is checkpointed with the watermarks it belongs to
+        for enhancer in self.enhancers.values():
+            enhancer.checkpoint(run, list(window_ends))
+        self.suppressor.evict()
+        self.suppressor.checkpoint(run, list(window_ends))
 
 
     def clean_empty_interval_job(self, interval: int):
@@ -273,7 +543,9 @@ class Executor(RuleManager):
         if file_path not in self.rules:
             return False
         rule = self.rules[file_path]
-        interval = interval_to_seconds(rule['schedule']['interval'])
+        interval = self.rule_groups.get(file_path, interval_to_seconds(rule['schedule']['interval']))
+        self.invalidate_enhancers(rule)
+        self.suppressor.remove(rule[RULE_ID])
         self.remove_rule(file_path)
         self.remove_rule_from_group(file_path, interval)
         self.clean_empty_interval_job(interval)
@@ -291,11 +563,24 @@ class Executor(RuleManager):
         self.setup_jobs()
         self.rules_watcher.start()
         self.exceptions_watcher.start()
+        if self.bulk_writer is not None:
+            self.bulk_writer.start()
         self.scheduler.start()
 
 
+    def _wait_for_groups(self):
+        """Wait for the group runs in progress. Scheduler jobs run in its threads, shutdown already waited."""
+        pass
+
+
     def stop(self):
         """Stop the executor."""
         self.rules_watcher.stop()
         self.exceptions_watcher.stop()
         self.scheduler.shutdown(wait=True)
+        self._wait_for_groups()
+        if self.search_workers is not None:
+            self.search_workers.shutdown(wait=True)
+        self.workers.shutdown(wait=True)
+        if self.bulk_writer is not None:
+            self.bulk_writer.close()
@@ -0,0 +1,179 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from opensearchpy import helpers
+
+from logger import openalert_logger
+from ultils import get_nested_value, ts_to_datetime, interval_to_seconds
+
+
+DEFAULT_TTL = '5m'
+DEFAULT_FULL_RELOAD = '1h'
+DEFAULT_REFRESH_OVERLAP = '1m'
+DEFAULT_TIMESTAMP_FIELD = '@timestamp'
+DEFAULT_MAX_FEEDS = 100
+DEFAULT_MAX_INDICATORS = 1000000
+SCAN_SIZE = 5000
+
+
+class IndicatorFeed(object):
+    """Indicators of one (index, query, fields) and their refresh state."""
+    def __init__(self, index):
+        self.index = index
+        # indicators: { _id: _source }, replaced (never mutated) on refresh so readers keep a consistent view
+        self.indicators = {}
+        self.high_water_mark = None
+        self.loaded_at = None
+        self.refreshed_at = None
+        # indexes: { mapping_key: hash indexes of IndicatorMatchEnhancement }
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+
+    def get_indexes(self, mapping, build_indexes):
+        """Return the hash indexes of a mapping, built once per version of the indicators."""
+        mapping_key = json.dumps(mapping, sort_keys=True)
+        with self.lock:
+            if mapping_key not in self.indexes:
+                self.indexes[mapping_key] = build_indexes(list(self.indicators.values()), mapping)
+            return self.indexes[mapping_key]
+
+
+class IndicatorStore(object):
+    """Indicators shared by all rules and runs, keyed by (index, query, fields).
+
+    A feed is loaded once, then refreshed every `ttl` with only the documents from its high-water mark
+    (max `timestampField`) minus `refreshOverlap`, so indicators with the same timestamp or indexed late
+    are not missed. A full reload every `fullReload` picks up deletions."""
+    def __init__(self, client, config=None):
+        config = config or {}
+        self.client = client
+        self.ttl = interval_to_seconds(config.get('ttl', DEFAULT_TTL))
+        self.full_reload = interval_to_seconds(config.get('fullReload', DEFAULT_FULL_RELOAD))
+        self.timestamp_field = config.get('timestampField', DEFAULT_TIMESTAMP_FIELD)
+        self.refresh_overlap = timedelta(seconds=interval_to_seconds(config.get('refreshOverlap',
+                                                                                DEFAULT_REFRESH_OVERLAP)))
+        self.max_feeds = config.get('maxFeeds', DEFAULT_MAX_FEEDS)
+        self.max_indicators = config.get('maxIndicators', DEFAULT_MAX_INDICATORS)
+
+        # feeds: { key: IndicatorFeed }, least recently used first
+        self.feeds: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+
+
+    @staticmethod
+    def get_key(index: list, query_section, fields) -> tuple:
+        return (tuple(index), json.dumps(query_section, sort_keys=True, default=str),
+                json.dumps(fields, sort_keys=True))
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'feeds': len(self.feeds), 'hits': self.hits, 'misses': self.misses,
+                    'refreshes': self.refreshes, 'evictions': self.evictions,
+                    'indicators': sum(len(feed.indicators) for feed in self.feeds.values())}
+
+
+    def get(self, index: list, query_section, fields, build_query) -> IndicatorFeed:
+        """Return the up-to-date feed of (index, query, fields). `build_query` converts the query on load."""
+        key = self.get_key(index, query_section, fields)
+        with self.lock:
+            feed = self.feeds.get(key)
+            if feed is None:
+                feed = IndicatorFeed(index)
+                self.feeds[key] = feed
+                while len(self.feeds) > self.max_feeds:
+                    self.feeds.popitem(last=False)
+                    self.evictions += 1
+            self.feeds.move_to_end(key)
+
+        # Rules sharing a feed wait for one load instead of all querying the cluster
+        with feed.lock:
+            now = time.monotonic()
+            if feed.loaded_at is None or now - feed.loaded_at >= self.full_reload:
+                self._load(feed, self._add_timestamp_field(build_query()), now)
+                counter = 'misses'
+            elif now - feed.refreshed_at >= self.ttl:
+                self._refresh(feed, self._add_timestamp_field(build_query()), now)
+                counter = 'refreshes'
+            else:
+                counter = 'hits'
+
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+        return feed
+
+
+    def _add_timestamp_field(self, query: dict) -> dict:
+        """Return the query with timestampField in its `_source` includes, the high-water mark needs it."""
+        includes = query.get('_source', {}).get('includes')
+        if not includes or self.timestamp_field in includes:
+            return query
+        return {**query, '_source': {**query['_source'], 'includes': includes + [self.timestamp_field]}}
+
+
+    def _scan(self, query: dict, index: list, indicators: dict):
+        """Read all matching documents into `indicators`, return the max timestamp seen and whether an
+        indicator was added or changed."""
+        high_water_mark = None
+        changed = False
+        for hit in helpers.scan(self.client, query=query, index=','.join(index), size=SCAN_SIZE):
+            if not hit.get('_source'):
+                continue
+            if len(indicators) >= self.max_indicators and hit['_id'] not in indicators:
+                openalert_logger.warning(fr'Indicator feed {index} exceeds maxIndicators={self.max_indicators}, '
+                                         fr'remaining indicators are ignored')
+                break
+
+            if indicators.get(hit['_id']) != hit['_source']:
+                indicators[hit['_id']] = hit['_source']
+                changed = True
+            timestamp = get_nested_value(hit['_source'], self.timestamp_field)
+            try:
+                timestamp = ts_to_datetime(timestamp)
+            except (TypeError, ValueError, AttributeError):
+                continue
+            if high_water_mark is None or timestamp > high_water_mark:
+                high_water_mark = timestamp
+
+        return high_water_mark, changed
+
+
+    def _load(self, feed: IndicatorFeed, query: dict, now: float):
+        indicators = {}
+        high_water_mark, _ = self._scan(query, feed.index, indicators)
+        feed.indicators = indicators
+        feed.high_water_mark = high_water_mark
+        feed.indexes = {}
+        feed.loaded_at = feed.refreshed_at = now
+        openalert_logger.info(fr'Loaded {len(indicators)} indicators from {feed.index}. Cache: {self.stats()}')
+
+
+    def _refresh(self, feed: IndicatorFeed, query: dict, now: float):
+        if feed.high_water_mark is None:
+            # Feed has no usable timestamp, only full reloads can update it
+            feed.refreshed_at = now
+            return
+
+        # Indicators already loaded are read again and only count as updated if they changed
+        start = feed.high_water_mark - self.refresh_overlap
+        time_range = {'range': {self.timestamp_field: {'gte': start.isoformat(),
+                                                       'format': 'strict_date_optional_time'}}}
+        query = {**query, 'query': {'bool': {'filter': [query['query'], time_range]}}}
+
+        indicators = dict(feed.indicators)
+        high_water_mark, updated = self._scan(query, feed.index, indicators)
+        feed.high_water_mark = max(feed.high_water_mark, high_water_mark or feed.high_water_mark)
+        if updated:
+            feed.indicators = indicators
+            feed.indexes = {}
+        feed.refreshed_at = now
+        openalert_logger.debug(fr'Refreshed indicators from {feed.index}. Updated: {updated}')
@@ -1,8 +1,17 @@
+import copy
+import hashlib
+import logging
 import os
-from jsonschema import validate
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-from ultils import  read_yaml
+from jsonschema.validators import validator_for
+
+from ultils import  read_yaml, parse_yaml
 from logger import openalert_logger
+from registry import Registry
 
 
 YAML_EXTENSIONS = ('.yml', '.yaml')
@@ -12,18 +21,110 @@ WORK_DIR = os.path.dirname(__file__)
 RULES_SCHEMA_PATH = os.path.join(WORK_DIR, 'schema/rule-schema.json')
 EXCEPTIONS_SCHEMA_PATH = os.path.join(WORK_DIR, 'schema/exception-schema.json')
 
+# fingerprint: (mtime_ns, size, sha256) of the file content that gave this result
+FileResult = namedtuple('FileResult', ['data', 'level', 'error', 'fingerprint', 'parse_time', 'validate_time'])
+
+# validators: { schema_path: compiled validator } - built once per process
+validators = {}
+
+
+def get_validator(schema_path):
+    """Get the compiled validator of a schema, checking the schema itself only once."""
+    if schema_path not in validators:
+        schema = read_yaml(schema_path)
+        validator_class = validator_for(schema)
+        validator_class.check_schema(schema)
+        validators[schema_path] = validator_class(schema)
+    return validators[schema_path]
+
+
+def is_schema_valid(file_content, validator) -> bool:
+    """Check if the file content matches the schema."""
+    def format_date_fields(fields):
+        """Format specified fields in the file content to 'YYYY-MM-DD'."""
+        for field in fields:
+            if field in file_content:
+                file_content[field] = file_content[field].strftime('%Y-%m-%d')
+
+    try:
+        format_date_fields(DATE_FIELDS)
+        return validator.is_valid(file_content)
+    except Exception:  # noqa: Avoid generic exception if possible
+        return False
+
+
+def get_content_error(file_content) -> str:
+    """Check what the schema cannot express. Return the error, None if the content is valid."""
+    threshold, suppression = file_content.get('threshold'), file_content.get('suppression')
+    if threshold is not None and suppression is not None:
+        # Threshold results only carry the values of the threshold fields
+        missing = [field for field in suppression['groupBy'] if field not in threshold.get('field', [])]
+        if missing:
+            return f'suppression.groupBy fields {missing} are not threshold fields'
+    return None
+
+
+def read_file(schema_path, file_path, previous: FileResult = None) -> FileResult:
+    """Read, parse and validate one file. Runs in the startup process pool.
+
+    `previous` is returned as is when the file has the same (mtime, size, hash), without parsing it again."""
+    try:
+        stat = os.stat(file_path)
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+    except Exception as e:
+        return FileResult({}, logging.ERROR, f'Error reading file {file_path}: {e}', None, 0, 0)
+
+    fingerprint = (stat.st_mtime_ns, stat.st_size, hashlib.sha256(raw).hexdigest())
+    if previous is not None and previous.fingerprint == fingerprint:
+        return previous
+
+    start = time.perf_counter()
+    try:
+        data = parse_yaml(raw.decode('utf-8'))
+    except Exception as e:
+        return FileResult({}, logging.ERROR, f'Error reading file {file_path}: {e}', fingerprint,
+                          time.perf_counter() - start, 0)
+    parsed = time.perf_counter()
+
+    valid = is_schema_valid(data, get_validator(schema_path))
+    validate_time = time.perf_counter() - parsed
+    if not valid:
+        return FileResult({}, logging.DEBUG, f'Invalid schema for file {file_path}', fingerprint,
+                          parsed - start, validate_time)
+
+    error = get_content_error(data)
+    if error:
+        return FileResult({}, logging.ERROR, f'Invalid file {file_path}: {error}', fingerprint, parsed - start,
+                          validate_time)
+
+    return FileResult(data, None, None, fingerprint, parsed - start, validate_time)
+
+
+def get_chunk_size(count: int, workers: int) -> int:
+    """Chunks of work sent to each pool process, a few per process to balance uneven files."""
+    return max(1, count // (workers * 4))
+
 
 class Loader(object):
-    def __init__(self, schema_path):
-        self.schema = read_yaml(schema_path)
+    def __init__(self, schema_path, workers=1):
+        self.schema_path = schema_path
+        self.validator = get_validator(schema_path)
+        # workers: processes used to read and validate files in load_all, 1 loads them in this process
+        self.workers = workers
         self.total = 0
         self.enabled = 0
         self.disabled = 0
+        self.errors = []
+
+        # files: { file_path: FileResult } - last result of each file, reused while the file is unchanged
+        self.files = {}
+        self.stats = {'files': 0, 'bytes': 0, 'unchanged': 0, 'parse_time': 0.0, 'validate_time': 0.0}
 
 
     @staticmethod
     def get_all_files(directory):
-        """Get all files in a directory."""
+        """Get all files in a directory, sorted so duplicates are always resolved in the same order."""
         files_path = []
         try:
             for filename in os.listdir(directory):
@@ -33,50 +134,87 @@ class Loader(object):
         except Exception as e:
             openalert_logger.error(f'Error accessing directory {directory}: {e}')
 
-        return files_path
-
-
-    @staticmethod
-    def is_duplicate_entry(content, content_dicts):
-        """Check if an entry with the same ID or name already exists."""
-        entry_id = content.get('id')
-        entry_name = content.get('name')
-        return any([
-            entry_id in {c.get('id') for c in content_dicts.values()},
-            entry_name in {c.get('name') for c in content_dicts.values()},
-        ])
+        return sorted(files_path)
 
 
     def is_schema_valid(self, file_content) -> bool:
         """Check if the file content matches the schema."""
-        def format_date_fields(fields):
-            """Format specified fields in the file content to 'YYYY-MM-DD'."""
-            for field in fields:
-                if field in file_content:
-                    file_content[field] = file_content[field].strftime('%Y-%m-%d')
-
-        try:
-            format_date_fields(DATE_FIELDS)
-            validate(file_content, self.schema)
-        except Exception:  # noqa: Avoid generic exception if possible
-            return False
-
-        return True
+        return is_schema_valid(file_content, self.validator)
 
 
     def load(self, file_path) -> dict:
         """Load content from a file."""
-        try:
-            data = read_yaml(file_path)
-        except Exception as e:
-            openalert_logger.error(f'Error reading file {file_path}: {e}')
-            return {}
+        result = self._read(file_path)
+        if result.error:
+            openalert_logger.log(result.level, result.error)
+        return result.data
+
+
+    def _read(self, file_path) -> FileResult:
+        """Read a file in this process, reusing the last result if the file is unchanged."""
+        return self._record(file_path, read_file(self.schema_path, file_path, self.files.get(file_path)))
+
+
+    def _record(self, file_path, result: FileResult) -> FileResult:
+        """Update the file cache and the throughput stats. Return a result the caller may modify."""
+        if result.fingerprint is None:
+            self.files.pop(file_path, None)
+            return result
+
+        if self.files.get(file_path) is result:
+            self.stats['unchanged'] += 1
+        else:
+            self.files[file_path] = result
+            self.stats['files'] += 1
+            self.stats['bytes'] += result.fingerprint[1]
+            self.stats['parse_time'] += result.parse_time
+            self.stats['validate_time'] += result.validate_time
+
+        # Loaded content is modified later (conversion), the cached one must stay as read
+        return result._replace(data=copy.deepcopy(result.data))
+
+
+    def forget(self, file_path):
+        """Drop the cached result of a deleted file."""
+        self.files.pop(file_path, None)
+
 
-        if not self.is_schema_valid(data):
-            openalert_logger.debug(f'Invalid schema for file {file_path}')
-            return {}
+    def load_files(self, file_paths: list):
+        """Yield (file_path, content) in file order. Files are read and validated by `workers` processes."""
+        if self.workers <= 1:
+            for file_path in file_paths:
+                openalert_logger.debug(f'Loading file: {file_path}')
+                yield file_path, self._collect(self._read(file_path))
+            return
 
-        return data
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = pool.map(partial(read_file, self.schema_path), file_paths,
+                               chunksize=get_chunk_size(len(file_paths), self.workers))
+            for file_path, result in zip(file_paths, results):
+                yield file_path, self._collect(self._record(file_path, result))
+
+
+    def _collect(self, result: FileResult) -> dict:
+        """Log the error of a file and keep it for the loading summary."""
+        if result.error:
+            openalert_logger.log(result.level, result.error)
+            self.errors.append(result.error)
+        return result.data
+
+
+    def _log_throughput(self):
+        stats = self.stats
+        parse_rate = stats['files'] / stats['parse_time'] if stats['parse_time'] else 0
+        validate_rate = stats['files'] / stats['validate_time'] if stats['validate_time'] else 0
+        openalert_logger.info(fr"Parsed {stats['files']} files ({stats['bytes'] / 1024:.1f} KiB) in "
+                              fr"{stats['parse_time']:.3f}s ({parse_rate:.0f} files/s), validated in "
+                              fr"{stats['validate_time']:.3f}s ({validate_rate:.0f} files/s), "
+                              fr"unchanged: {stats['unchanged']}")
+
+
+    def _log_summary(self, kind):
+        if self.errors:
+            openalert_logger.warning(f'{len(self.errors)} {kind} files could not be loaded')
 
 
     def load_all(self):
@@ -85,11 +223,13 @@ class Loader(object):
 
 
 class RulesLoader(Loader):
-    def __init__(self, directory, schema_path):
-        super().__init__(schema_path)
+    def __init__(self, directory, schema_path, workers=1):
+        super().__init__(schema_path, workers)
         self.directory = directory
         self.rules = {}
         self.disabled_rules = {}
+        # registry: ids and names of the enabled and disabled rules loaded so far
+        self.registry = Registry()
 
 
     def load_all(self):
@@ -97,17 +237,13 @@ class RulesLoader(Loader):
         if not os.path.isdir(self.directory):
             raise Exception(f'{self.directory} is not a directory.')
 
-        for file_path in self.get_all_files(self.directory):
-            if not file_path.endswith(YAML_EXTENSIONS):
-                continue
-
-            openalert_logger.debug(f'Loading file: {file_path}')
-            rule_content = self.load(file_path)
-
-            if not rule_content or self.is_duplicate_entry(rule_content, {**self.rules, **self.disabled_rules}):
+        file_paths = [path for path in self.get_all_files(self.directory) if path.endswith(YAML_EXTENSIONS)]
+        for file_path, rule_content in self.load_files(file_paths):
+            if not rule_content or self.registry.is_duplicate(rule_content):
                 openalert_logger.warning(f'Skipping invalid/duplicate rule: Path={file_path}')
                 continue
 
+            self.registry.add(file_path, rule_content)
             self.total += 1
 
             if rule_content.get('enabled', True):
@@ -117,6 +253,8 @@ class RulesLoader(Loader):
                 self.disabled_rules[file_path] = rule_content
                 self.disabled += 1
 
+        self._log_summary('rule')
+        self._log_throughput()
         openalert_logger.info(f'Rule loading is complete. Enabled: {self.enabled}, Disabled: {self.disabled},'
                               f'Total: {self.total}')
 
@@ -124,10 +262,11 @@ class RulesLoader(Loader):
 
 
 class ExceptionsLoader(Loader):
-    def __init__(self, directory, schema_path):
-        super().__init__(schema_path)
+    def __init__(self, directory, schema_path, workers=1):
+        super().__init__(schema_path, workers)
         self.directory = directory
         self.exceptions = {}
+        self.registry = Registry()
 
 
     def load_all(self) -> dict:
@@ -135,22 +274,20 @@ class ExceptionsLoader(Loader):
         if not os.path.isdir(self.directory):
             raise Exception(f'{self.directory} is not a directory.')
 
-        for file_path in self.get_all_files(self.directory):
-            if not file_path.endswith(YAML_EXTENSIONS):
-                continue
-
-            openalert_logger.debug(f'Loading file: {file_path}')
-            exception_content = self.load(file_path)
-
-            if not exception_content or self.is_duplicate_entry(exception_content, {**self.exceptions}):
+        file_paths = [path for path in self.get_all_files(self.directory) if path.endswith(YAML_EXTENSIONS)]
+        for file_path, exception_content in self.load_files(file_paths):
+            if not exception_content or self.registry.is_duplicate(exception_content):
                 openalert_logger.debug(f'Skipping duplicate exception: Path={file_path}')
                 continue
 
+            self.registry.add(file_path, exception_content)
             self.total += 1
 
             self.exceptions[file_path] = exception_content
             self.enabled += 1
 
+        self._log_summary('exception')
+        self._log_throughput()
         openalert_logger.info(f'Exception loading is complete. Total: {self.total}')
 
         return self.exceptions
@@ -23,6 +23,7 @@ class OpenAlert(object):
         # Preparing folders
         self.rules_folder = config['rule']['rulesFolder']
         self.exceptions_folder = config['rule']['exceptionsFolder']
+        self.startup_workers = config['rule'].get('startupWorkers', 1)
 
         openalert_logger.info('Begin loading rules and exceptions...')
 
@@ -30,15 +31,20 @@ class OpenAlert(object):
         self.rules, self.disabled_rules, self.exceptions = self._load_resources()
 
         # Executor setup
-        self.executor = Executor(self.rules, self.disabled_rules, self.exceptions, config)
+        if config['rule'].get('executionMode', 'thread') == 'asyncio':
+            from async_executor import AsyncExecutor
+            openalert_logger.info('Execution mode: asyncio')
+            self.executor = AsyncExecutor(self.rules, self.disabled_rules, self.exceptions, config)
+        else:
+            self.executor = Executor(self.rules, self.disabled_rules, self.exceptions, config)
 
 
     def _load_resources(self):
         """Helper method to load rules and exceptions using respective loaders."""
-        rules_loader = RulesLoader(self.rules_folder, RULES_SCHEMA_PATH)
+        rules_loader = RulesLoader(self.rules_folder, RULES_SCHEMA_PATH, self.startup_workers)
         rules, disabled_rules = rules_loader.load_all()
 
-        exceptions_loader = ExceptionsLoader(self.exceptions_folder, EXCEPTIONS_SCHEMA_PATH)
+        exceptions_loader = ExceptionsLoader(self.exceptions_folder, EXCEPTIONS_SCHEMA_PATH, self.startup_workers)
         exceptions = exceptions_loader.load_all()
 
         return rules, disabled_rules, exceptions
@@ -2,18 +2,35 @@ import json
 
 from opensearchpy import OpenSearch
 
+try:
+    from opensearchpy import AsyncOpenSearch
+except ImportError:  # AsyncOpenSearch is only available when aiohttp is installed
+    AsyncOpenSearch = None
+
+
+def get_client_params(config) -> dict:
+    """Connection parameters shared by the sync and async clients."""
+    return dict(
+        hosts=config['opensearch']['hosts'],
+        http_compress=True,
+        http_auth=(config['opensearch']['username'], config['opensearch']['password']),
+        use_ssl=config['opensearch']['ssl']['enabled'],
+        verify_certs=config['opensearch']['ssl'].get('verifyCerts', True),
+        ca_certs=config['opensearch']['ssl'].get('certificateAuthorities', None),
+        client_cert=config['opensearch']['ssl'].get('certificate', None),
+        client_key=config['opensearch']['ssl'].get('key', None),
+        ssl_show_warn=False,
+        timeout=config['opensearch'].get('timeout', 30000),
+    )
+
 
 class OpenSearchClient(OpenSearch):
     def __init__(self, config):
-        super(OpenSearchClient, self).__init__(
-            hosts=config['opensearch']['hosts'],
-            http_compress=True,
-            http_auth=(config['opensearch']['username'], config['opensearch']['password']),
-            use_ssl=config['opensearch']['ssl']['enabled'],
-            verify_certs=config['opensearch']['ssl'].get('verifyCerts', True),
-            ca_certs=config['opensearch']['ssl'].get('certificateAuthorities', None),
-            client_cert=config['opensearch']['ssl'].get('certificate', None),
-            client_key=config['opensearch']['ssl'].get('key', None),
-            ssl_show_warn=False,
-            timeout=config['opensearch'].get('timeout', 30000),
-        )
+        super(OpenSearchClient, self).__init__(**get_client_params(config))
+
+
+def create_async_client(config):
+    """Create an AsyncOpenSearch client with the same settings as OpenSearchClient."""
+    if AsyncOpenSearch is None:
+        raise Exception('asyncio execution mode requires aiohttp. Install it with: pip install aiohttp')
+    return AsyncOpenSearch(**get_client_params(config))
@@ -0,0 +1,83 @@
+from logger import openalert_logger
+
+
+TIMESTAMP = '@timestamp'
+SIZE = 'size'
+SORT = 'sort'
+PIT = 'pit'
+PIT_ID = 'pit_id'
+SEARCH_AFTER = 'search_after'
+HITS = 'hits'
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_KEEP_ALIVE = '1m'
+
+# Oldest events first, so a rule stopped by maxSignals still alerts on the earliest matches.
+pattern_sort = [{TIMESTAMP: {'order': 'asc', 'unmapped_type': 'date'}}, {'_doc': 'asc'}]
+# Inside a point in time, _shard_doc is a unique tiebreaker across shards and indices
+pit_sort = [{TIMESTAMP: {'order': 'asc', 'unmapped_type': 'date'}}, {'_shard_doc': 'asc'}]
+
+
+class HitPaginator(object):
+    """Stream search hits page by page using a point-in-time and search_after."""
+    def __init__(self, client, page_size=DEFAULT_PAGE_SIZE, keep_alive=DEFAULT_KEEP_ALIVE):
+        self.client = client
+        self.page_size = page_size
+        self.keep_alive = keep_alive
+
+
+    def prepare_query(self, query: dict, size: int) -> dict:
+        """Return a copy of the query with page size (at least 1) and the oldest events first."""
+        return {**query, SIZE: max(1, min(size, self.page_size)), SORT: pattern_sort}
+
+
+    def _open_pit(self, index: list):
+        response = self.client.create_point_in_time(index=','.join(index), keep_alive=self.keep_alive)
+        return response[PIT_ID]
+
+
+    def _close_pit(self, pit_id):
+        try:
+            self.client.delete_point_in_time(body={PIT_ID: [pit_id]})
+        except Exception as e:
+            openalert_logger.warning(f'Cannot delete point in time. ERROR: {e}')
+
+
+    def pages(self, index: list, query: dict, first_response: dict):
+        """Yield lists of hits, starting with the page already returned for the query.
+
+        Further pages are only fetched if the consumer keeps iterating, so callers can stop
+        early by breaking out of the loop (the generator closes the point in time).
+
+        The first page is not searched in the point in time, its sort values cannot be used
+        there. The point in time is walked from the start with a unique tiebreaker instead,
+        skipping the hits of the first page, so no hit is missed or returned twice."""
+        hits = first_response[HITS][HITS]
+        yield hits
+
+        size = max(1, query.get(SIZE, 1))
+        if len(hits) < size:
+            return
+
+        seen = {(hit['_index'], hit['_id']) for hit in hits}
+        query = {**query, SIZE: size, SORT: pit_sort}
+        pit_id = self._open_pit(index)
+        try:
+            search_after = None
+            while True:
+                body = {**query, PIT: {'id': pit_id, 'keep_alive': self.keep_alive}}
+                if search_after is not None:
+                    body[SEARCH_AFTER] = search_after
+                response = self.client.search(body=body)
+                pit_id = response.get(PIT_ID, pit_id)
+                page = response[HITS][HITS]
+                if not page:
+                    return
+                search_after = page[-1][SORT]
+                hits = [hit for hit in page if (hit['_index'], hit['_id']) not in seen]
+                if hits:
+                    yield hits
+                if len(page) < size:
+                    return
+        finally:
+            self._close_pit(pit_id)
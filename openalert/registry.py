@@ -0,0 +1,72 @@
+from typing import Dict, Any, List, Optional
+
+
+ID = 'id'
+NAME = 'name'
+
+
+class Registry(object):
+    """Index of rules/exceptions by id and name, so lookups and duplicate checks do not scan every entry."""
+    def __init__(self, entries: Optional[Dict[str, Dict[str, Any]]] = None):
+        # by_id: { id: [file_path] }, by_name: { name: [file_path] } - files having the key, in registration
+        # order, the first one owns it
+        self.by_id: Dict[Any, List[str]] = {}
+        self.by_name: Dict[Any, List[str]] = {}
+        # keys: { file_path: (id, name) } - keys registered by each file
+        self.keys: Dict[str, tuple] = {}
+        for file_path, entry in (entries or {}).items():
+            self.add(file_path, entry)
+
+
+    def __contains__(self, file_path):
+        return file_path in self.keys
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def add(self, file_path: str, entry: Dict[str, Any]):
+        """Register (or re-register) the id and name of a file."""
+        self.remove(file_path)
+        entry_id, entry_name = entry.get(ID), entry.get(NAME)
+        self.keys[file_path] = (entry_id, entry_name)
+        self.by_id.setdefault(entry_id, []).append(file_path)
+        self.by_name.setdefault(entry_name, []).append(file_path)
+
+
+    @staticmethod
+    def _release(index: Dict[Any, List[str]], key, file_path: str):
+        owners = index.get(key, [])
+        if file_path in owners:
+            owners.remove(file_path)
+        if not owners:
+            index.pop(key, None)
+
+
+    def remove(self, file_path: str) -> bool:
+        """Unregister a file. A key stays registered while another file (a duplicate) has it."""
+        if file_path not in self.keys:
+            return False
+        entry_id, entry_name = self.keys.pop(file_path)
+        self._release(self.by_id, entry_id, file_path)
+        self._release(self.by_name, entry_name, file_path)
+        return True
+
+
+    def is_duplicate(self, entry: Dict[str, Any], file_path: Optional[str] = None) -> bool:
+        """Check if another file already has the id or the name of the entry."""
+        for index, key in ((self.by_id, entry.get(ID)), (self.by_name, entry.get(NAME))):
+            if any(owner != file_path for owner in index.get(key, [])):
+                return True
+        return False
+
+
+    def get_path_by_id(self, entry_id) -> Optional[str]:
+        owners = self.by_id.get(entry_id)
+        return owners[0] if owners else None
+
+
+    def get_path_by_name(self, entry_name) -> Optional[str]:
+        owners = self.by_name.get(entry_name)
+        return owners[0] if owners else None
@@ -1,8 +1,17 @@
-from typing import Dict, Any
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Dict, Any, Set
 
+from converter import Converter, OPEN_SEARCH_QUERY
+from registry import Registry
 from ultils import interval_to_seconds
 
 
+# rules: ((file_path, rule, compiled query), ...) - never modified, a change publishes a new snapshot
+GroupSnapshot = namedtuple('GroupSnapshot', ['version', 'interval', 'rules'])
+
+
 class RuleManager(object):
     def __init__(self, rules, disabled_rules, exceptions):
         self.rules = rules
@@ -11,6 +20,29 @@ class RuleManager(object):
 
         # grouped_rules: { interval: { file_path: rule_dict } }
         self.grouped_rules: Dict[int, Dict[str, Dict[str, Any]]] = {}
+        # rule_groups: { file_path: interval } - group of each rule
+        self.rule_groups: Dict[str, int] = {}
+
+        # rule_registry: ids/names of enabled and disabled rules, exception_registry: ids/names of exceptions
+        self.rule_registry = Registry()
+        self.exception_registry = Registry()
+
+        # exceptions_by_id: { exception_id: exception_dict }
+        self.exceptions_by_id: Dict[str, Dict[str, Any]] = {}
+        # exception_rules: { exception_id: { file_path } } - rules referencing the exception
+        self.exception_rules: Dict[str, Set[str]] = {}
+        # rule_exceptions: { file_path: [exception_id] } - exceptions referenced by the compiled rule
+        self.rule_exceptions: Dict[str, list] = {}
+        # compiled_queries: { file_path: final OpenSearch query (rule query + exceptionsList) }
+        self.compiled_queries: Dict[str, Dict[str, Any]] = {}
+
+        # snapshots: { interval: GroupSnapshot } - what group runs read, replaced as a whole by publish()
+        self.snapshots: Dict[int, GroupSnapshot] = {}
+        self.version = 0
+        # dirty_groups: { interval } - groups changed since the last publish
+        self.dirty_groups: Set[int] = set()
+        # rules_lock: serializes writers (watcher batches), readers only use the snapshots
+        self.rules_lock = threading.RLock()
 
         # Load initial
         self.load_initial_rules()
@@ -22,11 +54,124 @@ class RuleManager(object):
             self.add_rule_to_group(file_path, self.rules[file_path])
 
 
+    def index_all(self):
+        """Rebuild the id/name registries from the current rules and exceptions."""
+        self.rule_registry = Registry({**self.disabled_rules, **self.rules})
+        self.exception_registry = Registry(self.exceptions)
+
+
+    def is_duplicate_rule(self, rule, file_path=None) -> bool:
+        """Check if another enabled/disabled rule has the id or name of the rule."""
+        return self.rule_registry.is_duplicate(rule, file_path)
+
+
+    def is_duplicate_exception(self, exception, file_path=None) -> bool:
+        """Check if another exception has the id or name of the exception."""
+        return self.exception_registry.is_duplicate(exception, file_path)
+
+
+    def get_rule_by_id(self, rule_id):
+        """Get an enabled or disabled rule by id."""
+        file_path = self.rule_registry.get_path_by_id(rule_id)
+        return self.rules.get(file_path) or self.disabled_rules.get(file_path)
+
+
+    def get_rule_group(self, file_path):
+        """Get the interval group of an enabled rule, None if it is not scheduled."""
+        return self.rule_groups.get(file_path)
+
+
+    @contextmanager
+    def updating_rules(self):
+        """Apply changes to rules/exceptions as one update, published to group runs when it ends."""
+        with self.rules_lock:
+            try:
+                yield
+            finally:
+                self.publish()
+
+
+    def publish(self):
+        """Build new snapshots of the changed groups and swap them in with one assignment."""
+        if not self.dirty_groups:
+            return
+        self.version += 1
+        snapshots = dict(self.snapshots)
+        for interval in self.dirty_groups:
+            group = self.grouped_rules.get(interval)
+            if not group:
+                snapshots.pop(interval, None)
+                continue
+            rules = tuple((file_path, rule, self.compiled_queries.get(file_path)) for file_path, rule in group.items())
+            snapshots[interval] = GroupSnapshot(self.version, interval, rules)
+        self.dirty_groups = set()
+        self.snapshots = snapshots
+
+
+    def get_group_snapshot(self, interval):
+        """Get the current snapshot of a group, None if the group has no rules. Lock free."""
+        return self.snapshots.get(interval)
+
+
+    def _mark_dirty(self, file_path):
+        interval = self.rule_groups.get(file_path)
+        if interval is not None:
+            self.dirty_groups.add(interval)
+
+
+    def compile_all_queries(self):
+        """Index exceptions by id and build the final query of every enabled rule."""
+        self.exceptions_by_id = {exception['id']: exception for exception in self.exceptions.values()}
+        self.exception_rules = {}
+        self.rule_exceptions = {}
+        self.compiled_queries = {}
+        for file_path in self.rules.keys():
+            self.compile_rule(file_path)
+
+
+    def compile_rule(self, file_path):
+        """Build the final query of a rule once, so runs never have to merge exceptions again."""
+        self.uncompile_rule(file_path)
+        rule = self.rules.get(file_path)
+        if not rule or OPEN_SEARCH_QUERY not in rule:
+            return False
+
+        exceptions = []
+        self.rule_exceptions[file_path] = rule.get('exceptionsList', [])
+        for exc_id in self.rule_exceptions[file_path]:
+            self.exception_rules.setdefault(exc_id, set()).add(file_path)
+            if exc_id in self.exceptions_by_id:
+                exceptions.append(self.exceptions_by_id[exc_id])
+
+        self.compiled_queries[file_path] = Converter.build_final_query(rule[OPEN_SEARCH_QUERY], exceptions)
+        self._mark_dirty(file_path)
+        return True
+
+
+    def uncompile_rule(self, file_path):
+        """Drop the final query of a rule and its exception references."""
+        if self.compiled_queries.pop(file_path, None) is not None:
+            self._mark_dirty(file_path)
+        for exc_id in self.rule_exceptions.pop(file_path, []):
+            rules = self.exception_rules.get(exc_id, set())
+            rules.discard(file_path)
+            if not rules:
+                self.exception_rules.pop(exc_id, None)
+
+
+    def recompile_exception_rules(self, exc_id):
+        """Rebuild the final query of the rules referencing an exception."""
+        for file_path in list(self.exception_rules.get(exc_id, ())):
+            self.compile_rule(file_path)
+
+
     def add_rule(self, file_path, rule):
         """Add a rule to the rules."""
         if file_path in self.rules:
             return False
         self.rules[file_path] = rule
+        self.rule_registry.add(file_path, rule)
+        self.compile_rule(file_path)
         return True
 
 
@@ -34,6 +179,8 @@ class RuleManager(object):
         """Update a rule to the rules."""
         if file_path in self.rules:
             self.rules[file_path] = rule
+            self.rule_registry.add(file_path, rule)
+            self.compile_rule(file_path)
             return True
         return False
 
@@ -45,22 +192,31 @@ class RuleManager(object):
             self.grouped_rules[interval] = {}
 
         self.grouped_rules[interval][file_path] = rule
+        self.rule_groups[file_path] = interval
+        self.dirty_groups.add(interval)
 
 
     def remove_rule_from_group(self, file_path: str, interval: int):
         """Remove a rule from the interval group."""
         if interval in self.grouped_rules and file_path in self.grouped_rules[interval]:
             del self.grouped_rules[interval][file_path]
+            self.dirty_groups.add(interval)
+            if self.rule_groups.get(file_path) == interval:
+                del self.rule_groups[file_path]
             return True
         return False
 
+
     def remove_rule(self, file_path):
         if file_path not in self.rules:
             return False
         rule = self.rules[file_path]
-        interval = interval_to_seconds(rule['schedule']['interval'])
+        interval = self.rule_groups.get(file_path, interval_to_seconds(rule['schedule']['interval']))
         # Delete from rules
         del self.rules[file_path]
+        if file_path not in self.disabled_rules:
+            self.rule_registry.remove(file_path)
+        self.uncompile_rule(file_path)
         # Delete from rules_group
         self.remove_rule_from_group(file_path, interval)
         return True
@@ -71,6 +227,7 @@ class RuleManager(object):
         if file_path in self.disabled_rules:
             return False
         self.disabled_rules[file_path] = rule
+        self.rule_registry.add(file_path, rule)
         return True
 
 
@@ -78,21 +235,41 @@ class RuleManager(object):
         if file_path not in self.disabled_rules:
             return False
         del self.disabled_rules[file_path]
+        if file_path not in self.rules:
+            self.rule_registry.remove(file_path)
         return True
 
 
+    def _index_exception(self, exception):
+        """Register an exception by id and recompile the rules using it."""
+        self.exceptions_by_id[exception['id']] = exception
+        self.recompile_exception_rules(exception['id'])
+
+
+    def _unindex_exception(self, exception):
+        """Unregister an exception by id and recompile the rules using it."""
+        if self.exceptions_by_id.get(exception['id']) is exception:
+            del self.exceptions_by_id[exception['id']]
+            self.recompile_exception_rules(exception['id'])
+
+
     def add_exception(self, file_path, exception):
         """Add an exception to the exceptionsList."""
         if file_path in self.exceptions:
             return False
         self.exceptions[file_path] = exception
+        self.exception_registry.add(file_path, exception)
+        self._index_exception(exception)
         return True
 
 
     def update_exception(self, file_path, exception):
         """Update an exception to the exceptionsList."""
         if file_path in self.exceptions:
+            self._unindex_exception(self.exceptions[file_path])
             self.exceptions[file_path] = exception
+            self.exception_registry.add(file_path, exception)
+            self._index_exception(exception)
             return True
         return False
 
@@ -100,5 +277,7 @@ class RuleManager(object):
     def remove_exception(self, file_path):
         if file_path not in self.exceptions:
             return False
-        del self.exceptions[file_path]
+        exception = self.exceptions.pop(file_path)
+        self.exception_registry.remove(file_path)
+        self._unindex_exception(exception)
         return True
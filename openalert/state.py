@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import threading
+
+from logger import openalert_logger
+
+
+# Runtime state lives outside the source tree: $OPENALERT_STATE_FOLDER, else $XDG_STATE_HOME/openalert
+DEFAULT_STATE_FOLDER = os.environ.get('OPENALERT_STATE_FOLDER') or os.path.join(
+    os.environ.get('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state'), 'openalert')
+WATERMARKS_FILE = 'watermarks.json'
+EQL_SEQUENCES_FOLDER = 'eql_sequences'
+CONVERSIONS_FILE = 'conversions.json'
+SUPPRESSION_FILE = 'suppression.json'
+
+
+def write_file(file_path, content: str):
+    """Write a state file atomically (write temp file then rename)."""
+    tmp_path = fr'{file_path}.tmp'
+    try:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
+    except Exception as e:
+        openalert_logger.error(f'Error writing state file {file_path}: {e}')
+
+
+class JsonStateStore(object):
+    """Thread-safe key/value state persisted as a single JSON file."""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.data = self.load()
+
+
+    def load(self) -> dict:
+        """Load state from disk. Return an empty state if the file is missing or broken."""
+        if not os.path.isfile(self.file_path):
+            return {}
+
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            openalert_logger.error(f'Error reading state file {self.file_path}: {e}')
+            return {}
+
+
+    def save(self):
+        """Write state to disk atomically (write temp file then rename)."""
+        with self.lock:
+            content = json.dumps(self.data)
+        write_file(self.file_path, content)
+
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+
+
+    def remove(self, key):
+        with self.lock:
+            return self.data.pop(key, None) is not None
+
+
+class WatermarkStore(JsonStateStore):
+    """Last successful window end of each rule: { rule_id: iso_timestamp }."""
+    def __init__(self, state_folder=DEFAULT_STATE_FOLDER):
+        super().__init__(os.path.join(state_folder, WATERMARKS_FILE))
+        openalert_logger.info(fr'Loaded {len(self.data)} rule watermarks from {self.file_path}')
+
+
+class EqlSequenceStore(JsonStateStore):
+    """Events kept by stateful EQL enhancements between runs: { rule_id: [event] }.
+
+    Each rule is saved in its own file of the eql_sequences folder, and only the rules changed since the last
+    save are written. Events are saved with the projection given with them (the fields their query uses)."""
+    def __init__(self, state_folder=DEFAULT_STATE_FOLDER):
+        # changed: rules set or removed since the last save
+        self.changed = set()
+        # projections: { rule_id: function returning the saved part of an event }
+        self.projections = {}
+        super().__init__(os.path.join(state_folder, EQL_SEQUENCES_FOLDER))
+
+
+    def _get_rule_file(self, rule_id) -> str:
+        return os.path.join(self.file_path, fr'{hashlib.sha256(str(rule_id).encode("utf-8")).hexdigest()}.json')
+
+
+    def load(self) -> dict:
+        """Load the events of every rule file. Broken files are skipped."""
+        if not os.path.isdir(self.file_path):
+            return {}
+
+        data = {}
+        for name in os.listdir(self.file_path):
+            if not name.endswith('.json'):
+                continue
+            file_path = os.path.join(self.file_path, name)
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    content = json.load(f)
+                data[content['rule_id']] = content['events']
+            except Exception as e:
+                openalert_logger.error(f'Error reading state file {file_path}: {e}')
+        return data
+
+
+    def set(self, key, value, projection=None):
+        with self.lock:
+            self.data[key] = value
+            self.changed.add(key)
+            if projection is not None:
+                self.projections[key] = projection
+            else:
+                self.projections.pop(key, None)
+
+
+    def remove(self, key):
+        with self.lock:
+            self.changed.add(key)
+            self.projections.pop(key, None)
+            return self.data.pop(key, None) is not None
+
+
+    def save(self):
+        """Write the files of the rules changed since the last save, delete those of removed rules."""
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            contents = {}
+            for rule_id in changed:
+                if rule_id not in self.data:
+                    contents[rule_id] = None
+                    continue
+                events = self.data[rule_id]
+                projection = self.projections.get(rule_id)
+                if projection is not None:
+                    events = [projection(event) for event in events]
+                contents[rule_id] = json.dumps({'rule_id': rule_id, 'events': events}, default=str)
+
+        for rule_id, content in contents.items():
+            file_path = self._get_rule_file(rule_id)
+            if content is not None:
+                write_file(file_path, content)
+                continue
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                openalert_logger.error(f'Error deleting state file {file_path}: {e}')
+
+
+class ConversionCache(JsonStateStore):
+    """Sigma to OpenSearch DSL conversions: { hash of detection section and pySigma versions: query }."""
+    def __init__(self, state_folder=DEFAULT_STATE_FOLDER):
+        super().__init__(os.path.join(state_folder, CONVERSIONS_FILE))
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+        # used: keys read or written since load, the others belong to deleted/changed rules
+        self.used = set()
+
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.hits += 1
+                self.used.add(key)
+                return self.data[key]
+            self.misses += 1
+            return default
+
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.used.add(key)
+            self.changed = True
+
+
+    def contains(self, key) -> bool:
+        with self.lock:
+            return key in self.data
+
+
+    def prune(self):
+        """Drop the conversions not used since load."""
+        with self.lock:
+            unused = [key for key in self.data if key not in self.used]
+            for key in unused:
+                del self.data[key]
+            self.changed = self.changed or bool(unused)
+
+
+    def save(self):
+        """Write the cache if a conversion was added or pruned."""
+        if self.changed:
+            self.changed = False
+            super().save()
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'entries': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
+
+class SuppressionStore(JsonStateStore):
+    """Open suppression windows of rules: { rule_id: { group-by key: window } }. Only saved with `persist`."""
+    def __init__(self, state_folder=DEFAULT_STATE_FOLDER, persist=False):
+        self.persist = persist
+        super().__init__(os.path.join(state_folder, SUPPRESSION_FILE))
+
+
+    def load(self) -> dict:
+        return super().load() if self.persist else {}
+
+
+    def save(self):
+        if self.persist:
+            super().save()
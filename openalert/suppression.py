@@ -0,0 +1,168 @@
+import json
+import time
+
+from alert import Alert, RuleMetadata, TIMESTAMP
+from state import SuppressionStore
+from ultils import get_nested_getter, interval_to_seconds, ts_to_datetime
+
+
+COUNT = 'count'
+DROP = 'drop'
+DEFAULT_DURATION = '1h'
+EVICTION_GRACE = 24 * 60 * 60  # persisted windows of rules deleted while stopped
+
+
+def get_event_time(event: dict):
+    """@timestamp of an event as a datetime, None if it is missing or invalid."""
+    try:
+        return ts_to_datetime(event[TIMESTAMP])
+    except Exception:
+        return None
+
+
+class Suppressor(object):
+    """Suppress the alerts of a rule having the same group-by values for a duration.
+
+    The first alert of a key is kept and opens a window of `duration`. Later alerts of the key in the window are
+    dropped (mode drop) or counted (mode count): when the window expires, one roll-up alert with the last
+    suppressed event and the number of suppressed alerts is emitted. Events already seen by the window (the
+    bufferTime overlap of the next run) are not counted again.
+
+    Window changes of a run are staged and only kept by checkpoint() once its alerts are indexed, a run searched
+    again after a failed send finds the windows as they were."""
+    def __init__(self, store: SuppressionStore):
+        self.store = store
+        # getters: { field: getter } - group-by fields are split only once
+        self.getters = {}
+        # staged: { (run, rule_id): { key: window } } - windows of runs whose alerts are not indexed yet
+        self.staged = {}
+
+
+    def _get_getter(self, field: str):
+        if field not in self.getters:
+            self.getters[field] = get_nested_getter(field)
+        return self.getters[field]
+
+
+    @staticmethod
+    def _get_terms_getter(field: str):
+        """Group-by value of a threshold result, read from the terms of its bucket (the loader rejects group-by
+        fields that are not threshold fields)."""
+        def get(match):
+            return next((term['value'] for term in match.get('terms', []) if term['field'] == field), None)
+        return get
+
+
+    def apply(self, rule: dict, metadata: RuleMetadata, alerts: list, timestamp: str, max_signals: int = None,
+              run=None) -> list:
+        """Return the roll-up alerts of the expired windows, then at most `max_signals` alerts not suppressed.
+
+        Roll-ups are never cut, alerts past `max_signals` open no window. Without `run` the windows are changed
+        at once."""
+        settings = rule['suppression']
+        fields = settings['groupBy']
+        # Threshold results are buckets, not events: their group-by values are the bucket terms
+        get_getter = self._get_terms_getter if 'threshold' in rule else self._get_getter
+        getters = [get_getter(field) for field in fields]
+        duration = interval_to_seconds(settings.get('duration', DEFAULT_DURATION))
+        mode = settings.get('mode', COUNT)
+        now = time.time()
+
+        rollups, kept = [], []
+        with self.store.lock:
+            staged = self.staged.get((run, rule['id'])) if run is not None else None
+            if staged is not None:
+                windows = staged
+            elif run is not None:
+                # Windows are copied, the changed ones are replaced and never modified in place
+                windows = dict(self.store.data.get(rule['id'], {}))
+                self.staged[(run, rule['id'])] = windows
+            else:
+                windows = self.store.data.setdefault(rule['id'], {})
+
+            # Expired windows first, a key alerting again opens a new window after its roll-up
+            for key, window in list(windows.items()):
+                if window['expires'] <= now:
+                    del windows[key]
+                    if window['count'] and window['last']:
+                        rollups.append(self._build_rollup(metadata, timestamp, window))
+
+            for alert in alerts:
+                values = [getter(alert.match) for getter in getters]
+                key = json.dumps(values, default=str)
+                event_time = get_event_time(alert.match)
+                window = windows.get(key)
+                if window is None:
+                    if max_signals is not None and len(kept) >= max_signals:
+                        continue  # Cut by maxSignals, never indexed so it does not suppress later alerts
+                    windows[key] = {
+                        'terms': [{'field': field, 'value': value} for field, value in zip(fields, values)],
+                        'start': timestamp, 'end': timestamp, 'expires': now + duration, 'count': 0, 'last': None,
+                        'lastSeen': event_time.isoformat() if event_time else None, 'lastId': alert.get_id(),
+                    }
+                    kept.append(alert)
+                    continue
+
+                alert_id = alert.get_id()
+                if event_time and window['lastSeen']:
+                    last_seen = ts_to_datetime(window['lastSeen'])
+                    if event_time < last_seen or (event_time == last_seen and alert_id == window['lastId']):
+                        continue  # Matched again by an overlapping window
+                window = windows[key] = dict(window)
+                if event_time:
+                    window['lastSeen'], window['lastId'] = event_time.isoformat(), alert_id
+                window['count'] += 1
+                window['end'] = timestamp
+                if mode == COUNT:
+                    window['last'] = {'match': alert.match, 'index': alert.index, 'id': alert.id,
+                                      'indicator': alert.indicator}
+
+        return rollups + kept
+
+
+    @staticmethod
+    def _build_rollup(metadata: RuleMetadata, timestamp: str, window: dict) -> Alert:
+        last = window['last']
+        suppression = {'terms': window['terms'], 'count': window['count'], 'start': window['start'],
+                       'end': window['end']}
+        return Alert(timestamp, metadata, last['match'], last['index'], last['id'], last['indicator'], suppression)
+
+
+    def evict(self, grace: float = EVICTION_GRACE):
+        """Drop windows expired for more than `grace` seconds, e.g. those of deleted rules never run again."""
+        now = time.time()
+        with self.store.lock:
+            for rule_id, windows in list(self.store.data.items()):
+                for key in [key for key, window in windows.items() if window['expires'] + grace <= now]:
+                    del windows[key]
+                if not windows:
+                    del self.store.data[rule_id]
+
+
+    def remove(self, rule_id):
+        """Drop the windows of a rule that stopped running (removed or disabled)."""
+        with self.store.lock:
+            for key in [key for key in self.staged if key[1] == rule_id]:
+                del self.staged[key]
+        self.store.remove(rule_id)
+
+
+    def checkpoint(self, run=None, rule_ids=()):
+        """Keep the windows staged by `run` for the rules whose alerts were indexed, then persist them."""
+        with self.store.lock:
+            committed = {key[1]: self.staged.pop(key) for key in list(self.staged) if key[0] == run}
+            for rule_id in rule_ids:
+                if rule_id not in committed:
+                    continue
+                if committed[rule_id]:
+                    self.store.data[rule_id] = committed[rule_id]
+                else:
+                    self.store.data.pop(rule_id, None)
+        self.store.save()
+
+
+    def discard(self, run):
+        """Drop the windows staged by a run, the next run searches its window again."""
+        with self.store.lock:
+            for key in [key for key in self.staged if key[0] == run]:
+                del self.staged[key]
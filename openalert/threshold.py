@@ -0,0 +1,67 @@
+from converter import THRESHOLD, THRESHOLD_AGGREGATION, OPEN_SEARCH_AGGREGATION, FIRST_SEEN, LAST_SEEN
+from eql_aggregation import EqlAggregation
+from paginator import SIZE, HITS
+
+
+class ThresholdAggregation(EqlAggregation):
+    """Threshold rule: OpenSearch counts the matching documents per value of the threshold fields.
+
+    The composite buckets are paged and filtered here (composite aggregations take no bucket_selector), each
+    bucket reaching the threshold value gives one result with its count and first/last event time. Without
+    fields the whole window is one bucket."""
+    name = THRESHOLD_AGGREGATION
+    fallback = False
+
+    def __init__(self, rule: dict):
+        threshold = rule[THRESHOLD]
+        super().__init__(threshold.get('field', []))
+        self.value = threshold['value']
+        # aggregation: compiled by the converter with the rule query
+        self.aggregation = rule[OPEN_SEARCH_AGGREGATION]
+
+
+    def build_query(self, query: dict) -> dict:
+        if not self.fields:
+            return {**query, SIZE: 0, 'track_total_hits': True, 'aggs': self.aggregation}
+        return {**query, SIZE: 0, 'aggs': self.aggregation}
+
+
+    def next_query(self, query: dict, response: dict):
+        if not self.fields:
+            return None
+        return super().next_query(query, response)
+
+
+    @staticmethod
+    def _get_time(aggregation: dict):
+        return aggregation.get('value_as_string', aggregation.get('value'))
+
+
+    def _build_result(self, values: list, count: int, aggregations: dict) -> dict:
+        return {
+            'key': values,
+            'terms': [{'field': field, 'value': value} for field, value in zip(self.fields, values)],
+            'count': count,
+            FIRST_SEEN: self._get_time(aggregations[FIRST_SEEN]),
+            LAST_SEEN: self._get_time(aggregations[LAST_SEEN]),
+        }
+
+
+    def get_results(self, responses: list) -> list:
+        """One result per bucket reaching the threshold, largest counts first."""
+        if not self.fields:
+            count = responses[0][HITS]['total']['value']
+            if count < self.value:
+                return []
+            return [self._build_result([], count, responses[0]['aggregations'])]
+
+        results = []
+        for response in responses:
+            for bucket in response['aggregations'][self.name]['buckets']:
+                if bucket['doc_count'] < self.value:
+                    continue
+                values = [bucket['key'][fr'f{i}'] for i in range(len(self.fields))]
+                results.append(self._build_result(values, bucket['doc_count'], bucket))
+
+        results.sort(key=lambda result: result['count'], reverse=True)
+        return results
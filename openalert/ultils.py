@@ -3,10 +3,17 @@ import yaml
 from datetime import datetime, timezone
 
 
+# libyaml loader (same constructors as FullLoader) when PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
+
+def parse_yaml(content: str):
+    return yaml.load(os.path.expandvars(content), Loader=YAML_LOADER)
+
+
 def read_yaml(path) -> dict:
     with open(path, 'r', encoding='utf-8') as f:
-        yaml_content = os.path.expandvars(f.read())
-        return yaml.load(yaml_content, Loader=yaml.FullLoader)
+        return parse_yaml(f.read())
 
 
 def interval_to_seconds(interval: str) -> int:
@@ -27,12 +34,33 @@ def ts_now():
     return now.isoformat()
 
 
+def ts_to_datetime(ts: str) -> datetime:
+    dt = datetime.fromisoformat(ts.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
 def get_nested_value(data, field_path):
     parts = field_path.split('.')
     val = data
     for p in parts:
-        if p in val:
+        if isinstance(val, dict) and p in val:
             val = val[p]
         else:
             return None
     return val
+
+
+def get_nested_getter(field_path):
+    """Return a function reading `field_path` from a dict, the path is split only once."""
+    parts = field_path.split('.')
+    def getter(data):
+        val = data
+        for p in parts:
+            if isinstance(val, dict) and p in val:
+                val = val[p]
+            else:
+                return None
+        return val
+    return getter
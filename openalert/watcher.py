@@ -1,85 +1,182 @@
 import os
+import threading
+import time
 from watchdog.events import PatternMatchingEventHandler
 from watchdog.observers import Observer
 
 from logger import openalert_logger
 from ultils import interval_to_seconds
-from loader import Loader, RULES_SCHEMA_PATH, EXCEPTIONS_SCHEMA_PATH
+from loader import Loader, RULES_SCHEMA_PATH, EXCEPTIONS_SCHEMA_PATH, YAML_EXTENSIONS
 
 
 YAML_PATTERNS = ['*.yaml', '*.yml']
+DEFAULT_DEBOUNCE = 1.0  # seconds without new events before a batch is processed
+MAX_DEBOUNCE_FACTOR = 10  # a continuous stream of events is still processed after debounce * factor
+MIN_PARALLEL_BATCH = 20  # smaller batches are parsed and converted in this process
 
 
 class Watcher(PatternMatchingEventHandler):
-    def __init__(self, directory, executor):
+    """Watch a folder and process its changed files in batches.
+
+    Events are coalesced per path until the folder is quiet for `debounce` seconds, then each changed file is
+    processed once, by its final state (present or deleted)."""
+    def __init__(self, directory, executor, debounce=DEFAULT_DEBOUNCE):
         super().__init__(patterns=YAML_PATTERNS, ignore_directories=True, case_sensitive=True)
         self.directory = directory
         self.executor = executor
+        self.debounce = debounce
         self.observer = Observer()
         self.observer.schedule(self, self.directory, recursive=False)
 
+        # pending: { file_path } - files changed since the last batch
+        self.pending = set()
+        self.pending_since = None
+        self.pending_lock = threading.Lock()
+        self.timer = None
+        # Batches are processed one at a time, in event order
+        self.batch_lock = threading.Lock()
+
     def start(self):
         self.observer.start()
 
     def stop(self):
         self.observer.stop()
         self.observer.join()
+        with self.pending_lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
 
+    def on_created(self, event):
+        self.add_pending(event.src_path)
 
-class RulesWatcher(Watcher):
-    def __init__(self, directory, executor):
-        super().__init__(directory, executor)
-        self.rules_loader = Loader(RULES_SCHEMA_PATH)
+    def on_modified(self, event):
+        self.add_pending(event.src_path)
 
-    def on_created(self, event):
-        file_path = event.src_path
-        loaded_rule = self.rules_loader.load(file_path)
-        if not loaded_rule or self.rules_loader.is_duplicate_entry(loaded_rule, self.executor.rules):
-            openalert_logger.info(fr'Failed to load rule: {file_path}')
-            return
+    def on_deleted(self, event):
+        self.add_pending(event.src_path)
+
+    def on_moved(self, event):
+        # Editors save through a temporary file renamed over the rule, git renames files
+        for file_path in (event.src_path, event.dest_path):
+            if file_path.endswith(YAML_EXTENSIONS):
+                self.add_pending(file_path)
+
+    def add_pending(self, file_path):
+        """Add a changed file to the next batch and restart the debounce timer."""
+        with self.pending_lock:
+            now = time.monotonic()
+            if not self.pending:
+                self.pending_since = now
+            self.pending.add(file_path)
+
+            if self.timer and now - self.pending_since >= self.debounce * MAX_DEBOUNCE_FACTOR:
+                return  # Waited long enough, let the running timer fire
+            if self.timer:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.debounce, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Process the pending files as one batch."""
+        with self.batch_lock:
+            with self.pending_lock:
+                file_paths, self.pending = sorted(self.pending), set()
+                self.timer = None
+            if not file_paths:
+                return
 
-        self.process_rule(file_path, loaded_rule, is_new=True)
+            start = time.perf_counter()
+            try:
+                self.process_batch(file_paths)
+            except Exception as e:
+                openalert_logger.error(fr'Cannot reload files of {self.directory}. ERROR: {e}')
+                return
+            openalert_logger.info(fr'Reloaded {len(file_paths)} files of {self.directory} '
+                                  fr'in {time.perf_counter() - start:.3f}s')
 
-    def on_modified(self, event):
-        file_path = event.src_path
-        if not os.path.exists(file_path):
-            return
+    def get_workers(self, count: int) -> int:
+        """Processes used to parse and convert a batch, a pool only pays off for large batches."""
+        return self.executor.startupWorkers if count >= MIN_PARALLEL_BATCH else 1
 
-        loaded_rule = self.rules_loader.load(file_path)
-        if not loaded_rule:
-            openalert_logger.info(fr'Failed to load rule: {file_path}')
-            self.remove_rule(file_path)
-            return
+    @staticmethod
+    def split_deleted(file_paths: list):
+        """Split a batch into (present, deleted) files."""
+        present, deleted = [], []
+        for file_path in file_paths:
+            (present if os.path.exists(file_path) else deleted).append(file_path)
+        return present, deleted
 
-        self.process_rule(file_path, loaded_rule, is_new=False)
+    def process_batch(self, file_paths: list):
+        raise NotImplementedError()
 
-    def on_deleted(self, event):
-        file_path = event.src_path
-        self.remove_rule(file_path)
 
-    def process_rule(self, file_path, rule, is_new):
-        if not rule:
-            self.remove_rule(file_path)
-            return
+class RulesWatcher(Watcher):
+    def __init__(self, directory, executor, debounce=DEFAULT_DEBOUNCE):
+        super().__init__(directory, executor, debounce)
+        self.rules_loader = Loader(RULES_SCHEMA_PATH)
 
-        if rule['enabled']:
-            rule = self.executor.converter.convert_rule(rule)
-            if not rule:
-                return
-            self.enable_rule(file_path, rule, is_new)
-        else:
+    def process_batch(self, file_paths: list):
+        """Load and convert the changed rules, then apply them to the executor at once.
+
+        Parsing, validation and conversion run before the update, and group runs keep reading the previous
+        snapshots until the whole batch is published."""
+        present, deleted = self.split_deleted(file_paths)
+        workers = self.get_workers(len(present))
+
+        self.rules_loader.workers = workers
+        self.rules_loader.errors = []
+        for file_path in deleted:
+            self.rules_loader.forget(file_path)
+        loaded_rules = dict(self.rules_loader.load_files(present))
+
+        enabled_rules = {file_path: rule for file_path, rule in loaded_rules.items()
+                         if rule and rule.get('enabled', True)}
+        converted_rules = self.executor.converter.convert_all(enabled_rules, 'rules', workers)
+        self.executor.converter.save_cache()
+
+        with self.executor.updating_rules():
+            # Deleted first, a rule renamed in the batch is not a duplicate of its old file
+            for file_path in deleted:
+                self.remove_rule(file_path)
+
+            for file_path in present:
+                rule = loaded_rules.get(file_path)
+                if not rule:
+                    openalert_logger.info(fr'Failed to load rule: {file_path}')
+                    self.remove_rule(file_path)
+                    continue
+                if self.executor.is_duplicate_rule(rule, file_path):
+                    openalert_logger.info(fr'Duplicate rule id/name, keeping the previous version: {file_path}')
+                    continue
+
+                self.process_rule(file_path, rule, converted_rules.get(file_path))
+
+    def process_rule(self, file_path, rule, converted_rule):
+        is_new = file_path not in self.executor.rules and file_path not in self.executor.disabled_rules
+        if not rule.get('enabled', True):
             self.disable_rule(file_path, rule, is_new)
+        elif converted_rule:
+            self.enable_rule(file_path, converted_rule, is_new)
+        else:
+            openalert_logger.info(fr'Failed to convert rule, keeping the previous version: {file_path}')
 
     def enable_rule(self, file_path, rule, is_new):
         new_interval = interval_to_seconds(rule['schedule']['interval'])
         old_rule = self.executor.rules.get(file_path, None)
-        old_interval = interval_to_seconds(old_rule['schedule']['interval']) if old_rule else None
+        old_interval = self.executor.get_rule_group(file_path)
+
+        if old_rule:
+            self.executor.invalidate_enhancers(old_rule)
 
         if old_rule and old_interval != new_interval:  # Move to a new rule group
             self.executor.remove_rule_from_group(file_path, old_interval)
             self.executor.clean_empty_interval_job(old_interval)
 
-        self.executor.rules[file_path] = rule
+        if not self.executor.update_rule(file_path, rule):
+            self.executor.add_rule(file_path, rule)
+        self.executor.remove_disabled_rule(file_path)  # The rule was disabled before
         self.executor.add_rule_to_group(file_path, rule)
         self.executor.ensure_job_exists(new_interval)
         action = "Modified" if not is_new else "Added"
@@ -89,7 +186,8 @@ class RulesWatcher(Watcher):
         if file_path in self.executor.rules:  # Remove existing enabled rule
             self.executor.remove_exits_rule_and_clean_job(file_path)
 
-        self.executor.disabled_rules[file_path] = rule
+        self.executor.remove_disabled_rule(file_path)
+        self.executor.add_disabled_rule(file_path, rule)
         action = "Modified" if not is_new else "Added"
         openalert_logger.info(fr'{action} disabled rule: {file_path}')
 
@@ -103,41 +201,47 @@ class RulesWatcher(Watcher):
 
 
 class ExceptionsWatcher(Watcher):
-    def __init__(self, directory, executor):
-        super().__init__(directory, executor)
+    def __init__(self, directory, executor, debounce=DEFAULT_DEBOUNCE):
+        super().__init__(directory, executor, debounce)
         self.exceptions_loader = Loader(EXCEPTIONS_SCHEMA_PATH)
 
-    def on_created(self, event):
-        self.process_exception(event.src_path, is_deleted=False)
-
-    def on_modified(self, event):
-        self.process_exception(event.src_path, is_deleted=False)
-
-    def on_deleted(self, event):
-        self.process_exception(event.src_path, is_deleted=True)
-
-
-    def process_exception(self, file_path, is_deleted):
-        if is_deleted:
-            if self.executor.remove_exception(file_path):
-                openalert_logger.info(fr'Deleted exception: {file_path}')
-            return
-
-        exception = self.exceptions_loader.load(file_path)
-        if not exception:
-            openalert_logger.warning(f'Invalid exception: {file_path}')
-            return
-
-        converted_exception = self.executor.converter.convert_exception(exception)
+    def process_batch(self, file_paths: list):
+        """Load and convert the changed exceptions, then apply them to the executor at once."""
+        present, deleted = self.split_deleted(file_paths)
+        workers = self.get_workers(len(present))
+
+        self.exceptions_loader.workers = workers
+        self.exceptions_loader.errors = []
+        for file_path in deleted:
+            self.exceptions_loader.forget(file_path)
+        loaded_exceptions = dict(self.exceptions_loader.load_files(present))
+
+        valid_exceptions = {file_path: exception for file_path, exception in loaded_exceptions.items() if exception}
+        converted_exceptions = self.executor.converter.convert_all(valid_exceptions, 'exceptionsList', workers)
+        self.executor.converter.save_cache()
+
+        with self.executor.updating_rules():
+            for file_path in deleted:
+                if self.executor.remove_exception(file_path):
+                    openalert_logger.info(fr'Deleted exception: {file_path}')
+
+            for file_path in present:
+                if not loaded_exceptions.get(file_path):
+                    openalert_logger.warning(f'Invalid exception: {file_path}')
+                    continue
+                self.process_exception(file_path, converted_exceptions.get(file_path))
+
+    def process_exception(self, file_path, converted_exception):
         if not converted_exception:
             openalert_logger.info(fr'Failed to load exception: {file_path}')
             self.executor.remove_exception(file_path)
             return
 
+        if self.executor.is_duplicate_exception(converted_exception, file_path):
+            openalert_logger.info(fr'Duplicate exception: {file_path}')
+            return
+
         if file_path not in self.executor.exceptions:
-            if self.exceptions_loader.is_duplicate_entry(converted_exception, self.executor.exceptions):
-                openalert_logger.info(fr'Duplicate exception: {file_path}')
-                return
             self.executor.add_exception(file_path, converted_exception)
             action = "Added"
         else:
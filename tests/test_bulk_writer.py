@@ -0,0 +1,88 @@
+import threading
+
+import bulk_writer
+from alert import Alert, RuleMetadata
+from bulk_writer import BulkWriter
+
+
+METADATA = RuleMetadata({'id': 'rule-1', 'name': 'Rule', 'description': '', 'riskScore': 50, 'severity': 'low',
+                         'tags': [], 'threat': []})
+
+
+def make_alerts(count):
+    return [Alert('2024-01-01T00:00:00Z', METADATA, {'n': i}, 'index', str(i)) for i in range(count)]
+
+
+class FakeBulk(object):
+    """streaming_bulk answering each request with the statuses of `responses` (one list per request)."""
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def __call__(self, client, actions, **kwargs):
+        self.requests.append([action['_id'] for action in actions])
+        statuses = self.responses.pop(0)
+        for action, status in zip(actions, statuses):
+            yield status < 300, {'create': {'_id': action['_id'], 'status': status}}
+
+
+def make_writer(monkeypatch, responses, **config):
+    fake_bulk = FakeBulk(responses)
+    monkeypatch.setattr(bulk_writer.helpers, 'streaming_bulk', fake_bulk)
+    return BulkWriter(None, 'alerts', {'initialBackoff': 0, 'flushInterval': 0.01, **config}), fake_bulk
+
+
+def test_submitted_alerts_reach_their_ticket(monkeypatch):
+    writer, fake_bulk = make_writer(monkeypatch, [[201, 201, 201]])
+    results = []
+    writer.start()
+
+    writer.submit(make_alerts(3), lambda success, errors: results.append((success, errors)))
+    writer.close()
+
+    assert results == [(3, [])]
+    assert len(fake_bulk.requests) == 1
+    assert writer.stats['sent'] == 3
+
+
+def test_rejected_documents_are_retried(monkeypatch):
+    writer, fake_bulk = make_writer(monkeypatch, [[201, 429, 429], [429, 201], [201]])
+    alerts = make_alerts(3)
+    results = []
+    ticket = bulk_writer.BulkTicket(3, lambda success, errors: results.append(success))
+
+    writer._send([(alert.get_id(), alert.to_json(), ticket) for alert in alerts])
+
+    assert fake_bulk.requests[1] == [alerts[1].get_id(), alerts[2].get_id()]
+    assert fake_bulk.requests[2] == [alerts[1].get_id()]
+    assert results == [3]
+    assert writer.stats['retried'] == 3
+
+
+def test_retries_give_up_after_max_retries(monkeypatch):
+    writer, _ = make_writer(monkeypatch, [[429], [429]], maxRetries=1)
+    alert = make_alerts(1)[0]
+    results = []
+    ticket = bulk_writer.BulkTicket(1, lambda success, errors: results.append((success, len(errors))))
+
+    writer._send([(alert.get_id(), alert.to_json(), ticket)])
+
+    assert results == [(0, 1)]
+    assert writer.stats['failed'] == 1
+
+
+def test_existing_and_recent_alerts_count_as_written(monkeypatch):
+    writer, fake_bulk = make_writer(monkeypatch, [[409, 201]])
+    results = []
+    written = threading.Event()
+    writer.start()
+
+    writer.submit(make_alerts(2), lambda success, errors: (results.append(success), written.set()))
+    assert written.wait(5)
+    # Written just before: dropped without a request
+    writer.submit(make_alerts(2), lambda success, errors: results.append(success))
+    writer.close()
+
+    assert results == [2, 2]
+    assert len(fake_bulk.requests) == 1
+    assert writer.stats['duplicates'] == 3
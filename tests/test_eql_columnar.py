@@ -0,0 +1,58 @@
+import eql
+import pytest
+
+from eql_columnar import compile_query, np
+
+
+pytestmark = pytest.mark.skipif(np is None, reason='numpy is not installed')
+
+EVENTS = [
+    {'event': {'category': 'process'}, 'user': 'Alice', 'port': 22, 'tags': ['a']},
+    {'event': {'category': 'network'}, 'user': 'alice', 'port': 443},
+    {'event': {'category': 'network'}, 'user': 'bob', 'port': '443'},
+    {'event': {'category': 'file'}, 'user': None, 'port': 8080.0},
+    {'event': {'category': 'file'}, 'port': True},
+]
+
+
+def parse(query):
+    with eql.Schema.learn([eql.Event('generic', 0, event) for event in EVENTS]):
+        return eql.parse_query(query, implied_any=True, implied_base=True)
+
+
+def run_engine(parsed_query):
+    results = []
+    engine = eql.PythonEngine()
+    engine.add_query(parsed_query)
+    engine.add_output_hook(lambda result: results.extend(event.data for event in result.events))
+    engine.stream_events([eql.Event('generic', i, event) for i, event in enumerate(EVENTS)])
+    return results
+
+
+@pytest.mark.parametrize('query', [
+    'any where port > 100',
+    'any where user == "ALICE"',
+    'any where user in ("bob", "alice") and port != 22',
+    'any where user == null or not port < 1000',
+    'any where true | count user',
+    'any where port > 0 | count user port',
+])
+def test_columnar_results_match_eql_engine(query):
+    parsed_query = parse(query)
+    columnar_query = compile_query(parsed_query)
+    assert columnar_query is not None
+
+    result = columnar_query.execute(EVENTS)
+    if result is None:
+        pytest.skip('events left to the eql engine')
+    assert result == run_engine(parsed_query)
+
+
+@pytest.mark.parametrize('query', [
+    'sequence [process where true] [network where true]',
+    'process where true',
+    'any where true | unique user',
+])
+def test_other_queries_are_not_compiled(query):
+    # Event types other than the generic one, parsed without the learned schema
+    assert compile_query(eql.parse_query(query, implied_any=True, implied_base=True)) is None
@@ -0,0 +1,71 @@
+from paginator import HitPaginator
+
+
+class FakeClient(object):
+    """Serves `hits` sorted by their sort values through a point in time."""
+    def __init__(self, hits):
+        self.hits = hits
+        self.searches = []
+        self.closed = []
+
+    def create_point_in_time(self, index, keep_alive):
+        return {'pit_id': 'pit'}
+
+    def delete_point_in_time(self, body):
+        self.closed.append(body)
+
+    def search(self, body):
+        self.searches.append(body)
+        search_after = body.get('search_after')
+        hits = [hit for hit in self.hits if search_after is None or hit['sort'] > search_after]
+        return {'hits': {'hits': hits[:body['size']]}}
+
+
+def make_hits(count):
+    # Several hits share a timestamp, _shard_doc breaks the ties
+    return [{'_index': fr'index-{i % 2}', '_id': str(i), 'sort': [i // 3, i], '_source': {}} for i in range(count)]
+
+
+def test_pages_return_every_hit_once():
+    hits = make_hits(10)
+    client = FakeClient(hits)
+    paginator = HitPaginator(client, page_size=3)
+    query = paginator.prepare_query({'query': {'match_all': {}}}, 3)
+    # The first page (from msearch, without point in time) is not in sort order
+    first = {'hits': {'hits': [hits[1], hits[0], hits[2]]}}
+
+    ids = [hit['_id'] for page in paginator.pages(['index-*'], query, first) for hit in page]
+
+    assert sorted(ids, key=int) == [str(i) for i in range(10)]
+    assert all(search['sort'][1] == {'_shard_doc': 'asc'} for search in client.searches)
+    assert client.closed == [{'pit_id': ['pit']}]
+
+
+def test_short_first_page_opens_no_point_in_time():
+    client = FakeClient(make_hits(2))
+    paginator = HitPaginator(client, page_size=3)
+    query = paginator.prepare_query({'query': {'match_all': {}}}, 3)
+
+    pages = list(paginator.pages(['index-*'], query, {'hits': {'hits': client.hits}}))
+
+    assert len(pages) == 1
+    assert client.searches == [] and client.closed == []
+
+
+def test_page_size_is_at_least_one():
+    paginator = HitPaginator(FakeClient([]), page_size=3)
+    assert paginator.prepare_query({'query': {}}, 0)['size'] == 1
+    assert list(paginator.pages(['index-*'], {'size': 0}, {'hits': {'hits': []}})) == [[]]
+
+
+def test_closing_early_closes_the_point_in_time():
+    client = FakeClient(make_hits(10))
+    paginator = HitPaginator(client, page_size=3)
+    query = paginator.prepare_query({'query': {'match_all': {}}}, 3)
+    pages = paginator.pages(['index-*'], query, {'hits': {'hits': client.hits[:3]}})
+
+    next(pages)
+    next(pages)
+    pages.close()
+
+    assert client.closed == [{'pit_id': ['pit']}]
@@ -0,0 +1,63 @@
+import os
+
+from state import EqlSequenceStore, JsonStateStore, EQL_SEQUENCES_FOLDER
+
+
+def test_json_state_round_trip(tmp_path):
+    file_path = str(tmp_path / 'state' / 'watermarks.json')
+    store = JsonStateStore(file_path)
+    store.set('rule-1', '2024-01-01T00:00:00Z')
+    store.save()
+
+    assert JsonStateStore(file_path).data == {'rule-1': '2024-01-01T00:00:00Z'}
+    assert not os.path.exists(fr'{file_path}.tmp')
+
+
+def test_broken_state_file_loads_empty(tmp_path):
+    file_path = tmp_path / 'watermarks.json'
+    file_path.write_text('{', encoding='utf-8')
+
+    assert JsonStateStore(str(file_path)).data == {}
+
+
+def test_sequences_are_saved_per_rule_with_their_projection(tmp_path):
+    store = EqlSequenceStore(str(tmp_path))
+    store.set('rule-1', [{'user': 'alice', 'message': 'x' * 100}], lambda event: {'user': event['user']})
+    store.set('rule-2', [{'user': 'bob'}])
+    store.save()
+
+    assert len(os.listdir(tmp_path / EQL_SEQUENCES_FOLDER)) == 2
+    assert EqlSequenceStore(str(tmp_path)).data == {'rule-1': [{'user': 'alice'}], 'rule-2': [{'user': 'bob'}]}
+    # The events kept in memory are not projected
+    assert 'message' in store.data['rule-1'][0]
+
+
+def test_only_changed_sequences_are_written(tmp_path):
+    store = EqlSequenceStore(str(tmp_path))
+    store.set('rule-1', [{'user': 'alice'}])
+    store.set('rule-2', [{'user': 'bob'}])
+    store.save()
+    rule_2_file = store._get_rule_file('rule-2')
+    mtime = os.stat(rule_2_file).st_mtime_ns
+
+    store.set('rule-1', [{'user': 'carol'}])
+    store.remove('rule-2')
+    os.utime(rule_2_file, ns=(mtime, mtime))
+    store.save()
+
+    assert not os.path.exists(rule_2_file)
+    assert EqlSequenceStore(str(tmp_path)).data == {'rule-1': [{'user': 'carol'}]}
+    assert store.changed == set()
+
+
+def test_unchanged_sequence_file_is_not_rewritten(tmp_path):
+    store = EqlSequenceStore(str(tmp_path))
+    store.set('rule-1', [{'user': 'alice'}])
+    store.save()
+    rule_file = store._get_rule_file('rule-1')
+    os.utime(rule_file, ns=(0, 0))
+
+    store.set('rule-2', [{'user': 'bob'}])
+    store.save()
+
+    assert os.stat(rule_file).st_mtime_ns == 0
@@ -0,0 +1,91 @@
+import time
+
+from alert import Alert, RuleMetadata
+from state import SuppressionStore
+from suppression import Suppressor
+
+
+RULE = {'id': 'rule-1', 'name': 'Rule', 'description': '', 'riskScore': 50, 'severity': 'low', 'tags': [],
+        'threat': [], 'suppression': {'groupBy': ['user'], 'duration': '1h', 'mode': 'count'}}
+METADATA = RuleMetadata(RULE)
+
+
+def make_alert(user, second, id=None):
+    match = {'@timestamp': fr'2024-01-01T00:00:{second:02d}Z', 'user': user}
+    return Alert('2024-01-01T00:01:00Z', METADATA, match, 'index', id or fr'{user}-{second}')
+
+
+def make_suppressor(tmp_path):
+    return Suppressor(SuppressionStore(str(tmp_path)))
+
+
+def test_alerts_of_a_key_are_suppressed_in_its_window(tmp_path):
+    suppressor = make_suppressor(tmp_path)
+    alerts = [make_alert('alice', 1), make_alert('alice', 2), make_alert('bob', 3)]
+
+    kept = suppressor.apply(RULE, METADATA, alerts, '2024-01-01T00:01:00Z')
+
+    assert [alert.match['user'] for alert in kept] == ['alice', 'bob']
+    assert suppressor.store.data['rule-1']['["alice"]']['count'] == 1
+
+
+def test_overlapping_runs_do_not_count_again(tmp_path):
+    suppressor = make_suppressor(tmp_path)
+    suppressor.apply(RULE, METADATA, [make_alert('alice', 1), make_alert('alice', 2)], '2024-01-01T00:01:00Z')
+    suppressor.apply(RULE, METADATA, [make_alert('alice', 2), make_alert('alice', 3)], '2024-01-01T00:02:00Z')
+
+    assert suppressor.store.data['rule-1']['["alice"]']['count'] == 2
+
+
+def test_max_signals_cuts_new_windows_only(tmp_path):
+    suppressor = make_suppressor(tmp_path)
+    alerts = [make_alert('alice', 1), make_alert('bob', 2), make_alert('carol', 3)]
+
+    kept = suppressor.apply(RULE, METADATA, alerts, '2024-01-01T00:01:00Z', max_signals=2)
+
+    assert [alert.match['user'] for alert in kept] == ['alice', 'bob']
+    # The cut alert opened no window, it is kept by the next run
+    assert '["carol"]' not in suppressor.store.data['rule-1']
+
+
+def test_expired_window_gives_a_rollup(tmp_path):
+    suppressor = make_suppressor(tmp_path)
+    suppressor.apply(RULE, METADATA, [make_alert('alice', 1), make_alert('alice', 2)], '2024-01-01T00:01:00Z')
+    suppressor.store.data['rule-1']['["alice"]']['expires'] = time.time() - 1
+
+    results = suppressor.apply(RULE, METADATA, [make_alert('alice', 5)], '2024-01-01T00:02:00Z')
+
+    rollup, alert = results
+    assert rollup.suppression == {'terms': [{'field': 'user', 'value': 'alice'}], 'count': 1,
+                                  'start': '2024-01-01T00:01:00Z', 'end': '2024-01-01T00:01:00Z'}
+    assert rollup.match['@timestamp'] == '2024-01-01T00:00:02Z'
+    assert alert.match['@timestamp'] == '2024-01-01T00:00:05Z'
+
+
+def test_staged_windows_are_kept_only_by_checkpoint(tmp_path):
+    suppressor = make_suppressor(tmp_path)
+    run = '2024-01-01T00:01:00Z'
+
+    suppressor.apply(RULE, METADATA, [make_alert('alice', 1)], run, run=run)
+    suppressor.discard(run)
+    assert suppressor.store.data == {}
+
+    # The retried run finds the windows as they were
+    kept = suppressor.apply(RULE, METADATA, [make_alert('alice', 1)], run, run=run)
+    assert len(kept) == 1
+    suppressor.checkpoint(run, ['rule-1'])
+    assert list(suppressor.store.data['rule-1']) == ['["alice"]']
+    assert suppressor.staged == {}
+
+
+def test_threshold_results_are_grouped_by_their_terms(tmp_path):
+    suppressor = make_suppressor(tmp_path)
+    rule = {**RULE, 'threshold': {'field': ['user'], 'value': 2}}
+    results = [Alert('2024-01-01T00:01:00Z', METADATA, {'key': ['alice'], 'count': count,
+                                                        'terms': [{'field': 'user', 'value': 'alice'}]})
+               for count in (3, 4)]
+
+    kept = suppressor.apply(rule, METADATA, results, '2024-01-01T00:01:00Z')
+
+    assert len(kept) == 1
+    assert suppressor.store.data['rule-1']['["alice"]']['terms'] == [{'field': 'user', 'value': 'alice'}]
@@ -0,0 +1,45 @@
+import pytest
+
+from converter import Converter, OPEN_SEARCH_AGGREGATION
+from threshold import ThresholdAggregation
+
+
+def make_rule(threshold):
+    return {'threshold': threshold, OPEN_SEARCH_AGGREGATION: Converter.build_threshold_aggregation(threshold)}
+
+
+def bucket(ip, count):
+    return {'key': {'f0': ip}, 'doc_count': count,
+            'first_seen': {'value': 1, 'value_as_string': '2024-01-01T00:00:00Z'},
+            'last_seen': {'value': 2, 'value_as_string': '2024-01-01T00:01:00Z'}}
+
+
+def test_buckets_reaching_the_value_are_returned_largest_first():
+    aggregation = ThresholdAggregation(make_rule({'field': ['source.ip'], 'value': 3}))
+    query = aggregation.build_query({'query': {'match_all': {}}})
+    assert query['size'] == 0
+    assert query['aggs']['threshold']['composite']['sources'] == [{'f0': {'terms': {'field': 'source.ip'}}}]
+
+    first = {'aggregations': {'threshold': {'after_key': {'f0': 'b'}, 'buckets': [bucket('a', 2), bucket('b', 5)]}}}
+    last = {'aggregations': {'threshold': {'buckets': [bucket('c', 9)]}}}
+    next_query = aggregation.next_query({**query, 'aggs': {'threshold': {
+        **query['aggs']['threshold'], 'composite': {**query['aggs']['threshold']['composite'], 'size': 2}}}}, first)
+    assert next_query['aggs']['threshold']['composite']['after'] == {'f0': 'b'}
+
+    results = aggregation.get_results([first, last])
+
+    assert [result['key'] for result in results] == [['c'], ['b']]
+    assert results[1] == {'key': ['b'], 'terms': [{'field': 'source.ip', 'value': 'b'}], 'count': 5,
+                          'first_seen': '2024-01-01T00:00:00Z', 'last_seen': '2024-01-01T00:01:00Z'}
+
+
+@pytest.mark.parametrize('total, expected', [(4, 1), (2, 0)])
+def test_without_fields_the_window_is_one_bucket(total, expected):
+    aggregation = ThresholdAggregation(make_rule({'value': 3}))
+    query = aggregation.build_query({'query': {'match_all': {}}})
+    response = {'hits': {'total': {'value': total}},
+                'aggregations': {'first_seen': {'value': 1}, 'last_seen': {'value': 2}}}
+
+    assert query['track_total_hits'] is True
+    assert aggregation.next_query(query, response) is None
+    assert len(aggregation.get_results([response])) == expected